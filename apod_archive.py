@@ -0,0 +1,381 @@
+'''
+Offline mirror of APOD metadata, and optionally thumbnails, on disk.
+
+    python apod_archive.py --dir archive --thumbnails   # resumes, fetches only the gaps
+
+The archive is a directory holding three things:
+
+    index.bin    header (magic, first day's ordinal, number of days), then
+                 one (offset, length) record per day. The length is
+                 UNSYNCED for a day never fetched, and 0 for a day the API
+                 has no entry for.
+    entries.dat  the entries' JSON, appended one after another
+    search.sqlite  a SqliteIndex of the entries, for search()
+    thumbs/      small JPEGs named by the SHA-256 of the entry's url
+
+Both files are memory-mapped, so opening the archive reads nothing, and
+looking up a date is one record read plus one slice. An ApodArchive
+works as the cache of rank_cached / render_mosaic and as their store
+(it serves thumbnails, never the network), so searching and
+downloading run without a connection. Opened read_only, as batch
+--archive does, asking for a date that was never synced is an AppError
+rather than a fetch. Syncing uses art's windowed build_url / get_result
+fetches. Writers take an exclusive lock on the archive's lock file and
+re-read the index under it, so several processes can sync at once.
+put_many indexes the entries it stores, so a search only reads the
+postings of its words, never every entry of the range.
+'''
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+import urllib.error
+import urllib.request
+from PIL import Image
+import art
+from apod_cache import DEFAULT_CACHE_DIR, RECENT_DAYS
+from search_index import SqliteIndex, top_k
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+HEADER = struct.Struct('<4sII')
+RECORD = struct.Struct('<QI')
+MAGIC = b'APA1'
+UNSYNCED = 0xFFFFFFFF
+
+# the first Astronomy Picture of the Day
+FIRST_DATE = '1995-06-16'
+
+# longest side of a stored thumbnail
+THUMBNAIL_SIZE = 1024
+
+
+def _map(path: str):
+    '''
+    Read-only memory map of a file, or None if it is missing or empty
+    '''
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def make_thumbnail(data: bytes, size: int = THUMBNAIL_SIZE) -> bytes:
+    '''
+    JPEG of an encoded image shrunk to fit size x size
+    '''
+    image = Image.open(io.BytesIO(data))
+    image.draft('RGB', (size, size))
+    image = image.convert('RGB')
+    image.thumbnail((size, size))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class ApodArchive:
+    '''
+    Date -> APOD entry archive
+    '''
+    def __init__(self, directory: str = None, today: datetime.date = None,
+                 read_only: bool = False):
+        if directory is None:
+            directory = os.path.join(DEFAULT_CACHE_DIR, 'archive')
+        self.directory = directory
+        self.read_only = read_only
+        # the store interface: an archive never downloads while rendering
+        self.downloads = 0
+        self._today = today
+        os.makedirs(os.path.join(directory, 'thumbs'), exist_ok=True)
+        self._index = None
+        self._data = None
+        self._open()
+        search_path = os.path.join(directory, 'search.sqlite')
+        new_search = not os.path.exists(search_path)
+        self._db = sqlite3.connect(search_path, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self.search_index = SqliteIndex(self._db)
+        if new_search and self._count:
+            # an archive synced before it had a search index
+            with self._locked():
+                self._index_entries(self.get_many(self._synced_dates()))
+
+    @property
+    def today(self) -> datetime.date:
+        '''
+        Today's date, fixed if one was given
+        '''
+        return self._today or datetime.date.today()
+
+    def _open(self):
+        self._close_maps()
+        self._index = _map(os.path.join(self.directory, 'index.bin'))
+        self._data = _map(os.path.join(self.directory, 'entries.dat'))
+        if self._index is None:
+            self._first, self._count = 0, 0
+            return
+        magic, self._first, self._count = HEADER.unpack_from(self._index)
+        if magic != MAGIC:
+            raise ValueError(f"{self.directory} is not an APOD archive")
+
+    def _close_maps(self):
+        for mapped in (self._index, self._data):
+            if mapped is not None:
+                mapped.close()
+
+    def _record(self, date: str) -> tuple:
+        '''
+        (offset, length) of a date, or (0, UNSYNCED) outside the index
+        '''
+        i = datetime.date.fromisoformat(date).toordinal() - self._first
+        if not 0 <= i < self._count:
+            return 0, UNSYNCED
+        return RECORD.unpack_from(self._index, HEADER.size + i * RECORD.size)
+
+    def get_many(self, dates: list) -> dict:
+        '''
+        Synced dates among dates, mapped to their entry or None
+        '''
+        found = {}
+        for date in dates:
+            offset, length = self._record(date)
+            if length == UNSYNCED:
+                continue
+            found[date] = json.loads(self._data[offset:offset + length]) if length else None
+        return found
+
+    def missing(self, dates: list) -> list:
+        '''
+        Dates never synced. A read-only archive has none to fetch, so
+        it raises AppError instead.
+        '''
+        missing = [date for date in dates if self._record(date)[1] == UNSYNCED]
+        if missing and self.read_only:
+            raise art.AppError(f"{missing[0]} is not in the archive at {self.directory}; "
+                               "sync it with apod_archive.py first")
+        return missing
+
+    @contextlib.contextmanager
+    def _locked(self):
+        '''
+        Holds the archive's exclusive write lock and re-reads the index
+        '''
+        with open(os.path.join(self.directory, 'lock'), 'ab') as file:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                self._open()
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+    def _synced_dates(self) -> list:
+        '''
+        Every date in the index that was synced
+        '''
+        return [datetime.date.fromordinal(self._first + i).isoformat()
+                for i in range(self._count)
+                if RECORD.unpack_from(self._index, HEADER.size + i * RECORD.size)[1] != UNSYNCED]
+
+    def last_synced(self) -> str:
+        '''
+        Latest synced date, or None
+        '''
+        for i in range(self._count - 1, -1, -1):
+            _, length = RECORD.unpack_from(self._index, HEADER.size + i * RECORD.size)
+            if length != UNSYNCED:
+                return datetime.date.fromordinal(self._first + i).isoformat()
+        return None
+
+    def put_many(self, entries: list, dates: list = ()):
+        '''
+        Stores entries by their date. Any of dates without an entry is
+        stored as having none. Entry data is appended and flushed
+        before the new index replaces the old one, so a crash leaves
+        the previous index intact.
+        '''
+        if self.read_only:
+            raise art.AppError(f"The archive at {self.directory} is read-only")
+        found = dict.fromkeys(dates)
+        for entry in entries:
+            if entry.get('date'):
+                found[entry['date']] = entry
+        if not found:
+            return
+        with self._locked():
+            self._write(found)
+            self._index_entries(found)
+        self._open()
+
+    def _index_entries(self, found: dict):
+        '''
+        Brings the search index in line with found, date -> entry or None
+        '''
+        with self._db:
+            for date, entry in found.items():
+                if entry is not None:
+                    self.search_index.add(date, entry)
+                else:
+                    self.search_index.remove(date)
+
+    def _write(self, found: dict):
+        '''
+        Appends the entries of found and swaps in the updated index.
+        Runs under the write lock, on the index as it is on disk.
+        '''
+        ordinals = [datetime.date.fromisoformat(date).toordinal() for date in found]
+        first = min(ordinals + ([self._first] if self._count else []))
+        last = max(ordinals + ([self._first + self._count - 1] if self._count else []))
+        records = bytearray(RECORD.pack(0, UNSYNCED) * (last - first + 1))
+        if self._count:
+            start = (self._first - first) * RECORD.size
+            records[start:start + self._count * RECORD.size] = \
+                self._index[HEADER.size:HEADER.size + self._count * RECORD.size]
+
+        data_path = os.path.join(self.directory, 'entries.dat')
+        offset = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+        with open(data_path, 'ab') as file:
+            for (date, entry), ordinal in zip(found.items(), ordinals):
+                blob = json.dumps(entry).encode() if entry is not None else b''
+                file.write(blob)
+                RECORD.pack_into(records, (ordinal - first) * RECORD.size, offset, len(blob))
+                offset += len(blob)
+            file.flush()
+            os.fsync(file.fileno())
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(HEADER.pack(MAGIC, first, last - first + 1))
+                file.write(records)
+            self._close_maps()
+            os.replace(tmp, os.path.join(self.directory, 'index.bin'))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def search(self, query: str, first: str, last: str, k: int) -> list:
+        '''
+        Dates of the k best matches for query from first to last, best first
+        '''
+        return top_k(self.search_index.scores(query, first, last), k)
+
+    def thumbnail_path(self, url: str) -> str:
+        '''
+        File holding the thumbnail of the image at url
+        '''
+        name = hashlib.sha256(url.encode()).hexdigest() + '.jpg'
+        return os.path.join(self.directory, 'thumbs', name)
+
+    def stored(self, url: str) -> str:
+        '''
+        Store interface: the archived thumbnail of url, or None
+        '''
+        path = self.thumbnail_path(url)
+        return path if os.path.exists(path) else None
+
+    def fetch(self, url: str) -> str:
+        '''
+        Store interface: the archived thumbnail of url. The network is
+        never used; unarchived images fail like a failed download.
+        '''
+        path = self.thumbnail_path(url)
+        if not os.path.exists(path):
+            raise urllib.error.URLError(f"{url} is not archived")
+        return path
+
+    def _save_thumbnail(self, url: str) -> int:
+        '''
+        Downloads url and stores its thumbnail, returns the bytes downloaded
+        '''
+        with urllib.request.urlopen(url) as response:
+            data = response.read()
+        thumbnail = make_thumbnail(data)
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.directory, 'thumbs'), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(thumbnail)
+        os.replace(tmp, self.thumbnail_path(url))
+        return len(data)
+
+    def sync(self, start_date: str = FIRST_DATE, end_date: str = None,
+             thumbnails: bool = False, chunk_days: int = art.CHUNK_DAYS,
+             workers: int = art.FETCH_WORKERS) -> dict:
+        '''
+        Fetches every date from start to end (default today) that was
+        never synced, plus the last RECENT_DAYS days, which may still
+        change. With thumbnails, also stores a thumbnail of each image
+        entry in the range that lacks one. Returns what was done.
+        '''
+        if end_date is None:
+            end_date = self.today.isoformat()
+        dates = art.date_range(start_date, end_date)
+        recent = (self.today - datetime.timedelta(days=RECENT_DAYS)).isoformat()
+        unsynced = set(self.missing(dates))
+        wanted = [date for date in dates if date in unsynced or date >= recent]
+        windows = art.chunk_ranges(art.missing_ranges(wanted), chunk_days)
+        for first, last, data in art.fetch_windows(windows, workers):
+            self.put_many(data, art.date_range(first, last))
+        report = {'days': len(dates), 'fetched': len(wanted), 'windows': len(windows),
+                  'thumbnails': 0, 'thumbnail_failures': 0}
+        if not thumbnails:
+            return report
+
+        urls = [entry['url'] for entry in self.get_many(dates).values()
+                if entry is not None and entry.get('url') and art.is_image_entry(entry)
+                and not os.path.exists(self.thumbnail_path(entry['url']))]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=art.DOWNLOAD_WORKERS) as pool:
+            futures = [pool.submit(self._save_thumbnail, url) for url in urls]
+            for future in futures:
+                try:
+                    future.result()
+                    report['thumbnails'] += 1
+                except (urllib.error.URLError, OSError, SyntaxError):
+                    report['thumbnail_failures'] += 1
+        return report
+
+    def close(self):
+        self._close_maps()
+        self._index = self._data = None
+        self._count = 0
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv: list = None):
+    '''
+    Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description="Mirror APOD metadata for offline use.")
+    parser.add_argument('--dir', help="archive directory (default: in the cache directory)")
+    parser.add_argument('--start', default=FIRST_DATE, help="first date to mirror")
+    parser.add_argument('--end', help="last date to mirror (default: today)")
+    parser.add_argument('--thumbnails', action='store_true', help="also store image thumbnails")
+    args = parser.parse_args(argv)
+    with ApodArchive(args.dir) as archive:
+        report = archive.sync(args.start, args.end, args.thumbnails)
+        print(f"{report['fetched']} of {report['days']} days fetched in "
+              f"{report['windows']} requests, {report['thumbnails']} thumbnails stored; "
+              f"synced through {archive.last_synced()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+'''
+On-disk cache of APOD entries keyed by date, stored in SQLite.
+
+A date is either cached with its entry, cached as having no entry
+(the API skipped it), or missing. Past dates never change, so they are
+kept for good. Dates close to today may still be published or edited,
+so they expire after ttl seconds. Cached entries are also added to a
+SqliteIndex in the same database, so search() never reads them all.
+'''
+import datetime
+import json
+import os
+import sqlite3
+import time
+from search_index import SqliteIndex, top_k
+
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'APOD_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'nasa-apod'))
+
+# dates within this many days of today use the ttl
+RECENT_DAYS = 1
+
+
+class ApodCache:
+    '''
+    Date -> APOD entry store
+    '''
+    def __init__(self, path: str = None, ttl: float = 3600, today: datetime.date = None):
+        if path is None:
+            path = os.path.join(DEFAULT_CACHE_DIR, 'apod.sqlite')
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self._today = today
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS apod '
+                         '(date TEXT PRIMARY KEY, entry TEXT, fetched_at REAL)')
+        self._db.commit()
+        self.index = SqliteIndex(self._db)
+
+    @property
+    def today(self) -> datetime.date:
+        '''
+        Today's date, fixed if one was given
+        '''
+        return self._today or datetime.date.today()
+
+    def _is_fresh(self, date: str, fetched_at: float) -> bool:
+        recent = self.today - datetime.timedelta(days=RECENT_DAYS)
+        if datetime.date.fromisoformat(date) < recent:
+            return True
+        return time.time() - fetched_at < self.ttl
+
+    def get_many(self, dates: list) -> dict:
+        '''
+        Fresh cached dates among dates, mapped to their entry or None
+        '''
+        found = {}
+        for i in range(0, len(dates), 500):
+            chunk = dates[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            rows = self._db.execute(
+                f'SELECT date, entry, fetched_at FROM apod WHERE date IN ({marks})', chunk)
+            for date, entry, fetched_at in rows:
+                if self._is_fresh(date, fetched_at):
+                    found[date] = json.loads(entry) if entry is not None else None
+        return found
+
+    def missing(self, dates: list) -> list:
+        '''
+        Dates that have to be fetched
+        '''
+        cached = self.get_many(dates)
+        return [date for date in dates if date not in cached]
+
+    def put_many(self, entries: list, dates: list = ()):
+        '''
+        Stores entries by their date. Any of dates without an entry is
+        stored as having none, so it is not fetched again.
+        '''
+        now = time.time()
+        found = dict.fromkeys(dates)
+        for entry in entries:
+            if entry.get('date'):
+                found[entry['date']] = entry
+        rows = [(date, json.dumps(entry) if entry is not None else None, now)
+                for date, entry in found.items()]
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO apod VALUES (?, ?, ?)', rows)
+            for date, entry in found.items():
+                if entry is None:
+                    self.index.remove(date)
+                else:
+                    self.index.add(date, entry)
+
+    def search(self, query: str, first: str, last: str, k: int) -> list:
+        '''
+        Dates of the k best matches for query from first to last, best first
+        '''
+        return top_k(self.index.scores(query, first, last), k)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
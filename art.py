@@ -1,10 +1,25 @@
+import argparse
+import asyncio
+import concurrent.futures
 import datetime
+import http.client
+import io
+import itertools
 import json 
+import os
 import urllib.request
 import urllib.parse
 import random
 import sys
-from simpleimage import SimpleImage
+import threading
+import time
+from PIL import Image
+import metrics
+from apod_cache import ApodCache
+from image_store import ImageStore
+from search_index import InvertedIndex, top_k
+from simpleimage import SimpleImage, output_format, write_bytes
+from transform_cache import content_hash, tile_key
 
 
 # NASA API Key
@@ -12,6 +27,24 @@ NASA_API_KEY = 'AVEFCQi0prul2RXKFEMKyS0PrBLSUFfeqeCF2zaO'
 
 BASE_NASA_URL = 'https://api.nasa.gov/planetary/apod'
 
+# Long date ranges are fetched as windows of this many days,
+# at most FETCH_WORKERS at a time
+CHUNK_DAYS = 31
+FETCH_WORKERS = 4
+
+# Images are downloaded DOWNLOAD_WORKERS at a time, streamed in chunks.
+# DOWNLOAD_SPARES extra ranked entries stand in for videos or failures.
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_SPARES = 4
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.tif', '.tiff')
+
+# To decide whether an entry's url is too small and its hdurl is needed,
+# the size is read from at most PROBE_BYTES of the url's download,
+# PROBE_CHUNK_SIZE at a time
+PROBE_BYTES = 64 * 1024
+PROBE_CHUNK_SIZE = 4 * 1024
+
 class AppError(Exception):
     '''
     Custom Exception
@@ -35,10 +68,10 @@ def get_input():
             print("Error: Please enter a valid date.")
 
 
-# Helper function to build the URL for querying the API
-def build_url(start_date: str, end_date: str) -> str:
+# Helper function to fill in default dates and check their format
+def resolve_dates(start_date: str, end_date: str) -> tuple:
     '''
-    Creates URL from query
+    Checks both dates, using defaults for empty ones
     '''
     if len(start_date.strip()) > 0:
         datetime.datetime.strptime(start_date, "%Y-%m-%d")
@@ -49,186 +82,725 @@ def build_url(start_date: str, end_date: str) -> str:
         datetime.datetime.strptime(end_date, "%Y-%m-%d")
     else:
         end_date = '2024-01-31'
+    return start_date, end_date
+
+# Helper function to build the URL for querying the API
+def build_url(start_date: str, end_date: str) -> str:
+    '''
+    Creates URL from query
+    '''
+    start_date, end_date = resolve_dates(start_date, end_date)
     url = f"{BASE_NASA_URL}?api_key={NASA_API_KEY}&start_date={start_date}&end_date={end_date}"
 
     return url
 
+def date_range(start_date: str, end_date: str) -> list:
+    '''
+    Every date from start to end inclusive, as YYYY-MM-DD strings
+    '''
+    start_date, end_date = resolve_dates(start_date, end_date)
+    day = datetime.date.fromisoformat(start_date)
+    end = datetime.date.fromisoformat(end_date)
+    dates = []
+    while day <= end:
+        dates.append(day.isoformat())
+        day += datetime.timedelta(days=1)
+    return dates
+
+def missing_ranges(dates: list) -> list:
+    '''
+    Groups sorted dates into (first, last) runs of consecutive days
+    '''
+    runs = []
+    for date in dates:
+        day = datetime.date.fromisoformat(date)
+        if runs and datetime.date.fromisoformat(runs[-1][1]) + datetime.timedelta(days=1) == day:
+            runs[-1][1] = date
+        else:
+            runs.append([date, date])
+    return [tuple(run) for run in runs]
+
 # Function to get results from the NASA APOD API
-def get_result(url: str) -> list:
+def get_result(url: str, attempts: int = 3, backoff: float = 0.5) -> list:
     '''
-    Retrieves data from API
+    Retrieves data from API. Network errors, rate limiting (429) and
+    server errors (5xx) are retried after backoff, 2 * backoff, ...
+    seconds. Other HTTP errors fail straight away.
     '''
-    attempts = 0
-    final = 3
-    for attempts in range(final):
+    for attempt in range(attempts):
         try:
             with urllib.request.urlopen(url) as res:
-                data = json.loads(res.read().decode())
+                body = res.read()
+                metrics.current().count('api_bytes', len(body))
+                data = json.loads(body)
                 if isinstance(data, dict):
                     data = [data]
                 return data
-        except urllib.error.HTTPError:
-            print("HTTP error")
-        except urllib.error.URLError:
-            print("Network error")
+        except urllib.error.HTTPError as e:
+            if e.code != 429 and e.code < 500:
+                raise AppError(f"HTTP error {e.code}: {e.reason}") from e
+            print(f"HTTP error {e.code}")
+        except urllib.error.URLError as e:
+            print(f"Network error: {e.reason}")
         except json.JSONDecodeError as e:
             raise AppError("Error decoding JSON") from e
-        attempts += 1
-        if attempts == final:
-            raise AppError("Failed after multiple attempts.")
+        if attempt + 1 < attempts:
+            time.sleep(backoff * 2 ** attempt * random.uniform(0.8, 1.2))
+    raise AppError("Failed after multiple attempts.")
 
-# Function to score and filter results based on query
-def search_description(search_result: list, query: str, max: int) -> list:
+def chunk_ranges(ranges: list, days: int = CHUNK_DAYS) -> list:
     '''
-    Gets the top two results
+    Splits (first, last) date ranges into windows of at most days days
     '''
-    query_total = query.lower().split()
-    scores = []
-    result = []
+    windows = []
+    step = datetime.timedelta(days=days)
+    for first, last in ranges:
+        day = datetime.date.fromisoformat(first)
+        end = datetime.date.fromisoformat(last)
+        while day <= end:
+            stop = min(day + step - datetime.timedelta(days=1), end)
+            windows.append((day.isoformat(), stop.isoformat()))
+            day = stop + datetime.timedelta(days=1)
+    return windows
+
+def fetch_windows(windows: list, workers: int = FETCH_WORKERS):
+    '''
+    Fetches date windows concurrently, yielding (first, last, data) in
+    window order as soon as each one is ready
+    '''
+    def fetch(window):
+        return window[0], window[1], get_result(build_url(*window))
 
-    if not max:
-        max = 2
-    else:
-        max = int(max)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(fetch, windows)
+
+def iter_result(start_date: str, end_date: str, chunk_days: int = CHUNK_DAYS,
+                workers: int = FETCH_WORKERS):
+    '''
+    Streams the entries of a date range, fetched in concurrent windows
+    '''
+    windows = chunk_ranges([resolve_dates(start_date, end_date)], chunk_days)
+    for _, _, data in fetch_windows(windows, workers):
+        yield from data
 
-    for item in search_result:
-        explanation = item.get('explanation', '').lower()
-        score = 0
-        for token in query_total:
-            token_count = explanation.count(token)
-            score += token_count
-        scores.append((score, item))
+# Function to fetch the dates of a range that the cache lacks
+def sync_dates(start_date: str, end_date: str, cache,
+               chunk_days: int = CHUNK_DAYS, workers: int = FETCH_WORKERS) -> list:
+    '''
+    Fills the cache for a date range, returns its dates
+    '''
+    dates = date_range(start_date, end_date)
+    missing = cache.missing(dates)
+    metrics.current().count('api_cache_hits', len(dates) - len(missing))
+    metrics.current().count('api_cache_misses', len(missing))
+    windows = chunk_ranges(missing_ranges(missing), chunk_days)
+    for first, last, data in fetch_windows(windows, workers):
+        cache.put_many(data, date_range(first, last))
+    return dates
+
+# Function to get results, fetching only dates the cache lacks
+def get_cached_result(start_date: str, end_date: str, cache,
+                      chunk_days: int = CHUNK_DAYS, workers: int = FETCH_WORKERS) -> list:
+    '''
+    Retrieves data for a date range through an ApodCache
+    '''
+    dates = sync_dates(start_date, end_date, cache, chunk_days, workers)
+    cached = cache.get_many(dates)
+    return [cached[date] for date in dates if cached.get(date) is not None]
 
-    total = len(scores)
-    for i in range(total):
-        for j in range(0, total - i - 1):
-            if scores[j][0] < scores[j + 1][0]:
-                scores[j], scores[j + 1] = scores[j + 1], scores[j]
+def _max_results(max) -> int:
+    '''
+    Number of results asked for, 2 if not given
+    '''
+    if not max:
+        return 2
+    return int(max)
 
-    high_score = scores[:max]
+# Function to rank entries against a query
+def rank_entries(search_result: list, query: str, max: int) -> list:
+    '''
+    The top entries by BM25 score of the title and explanation.
+    If fewer entries match, the earliest others fill the list.
+    '''
+    max = _max_results(max)
+    entries = list(search_result)
+    index = InvertedIndex()
+    for i, item in enumerate(entries):
+        index.add(i, item)
+
+    best = top_k(index.scores(query), max)
+    picked = set(best)
+    others = (i for i in range(len(entries)) if i not in picked)
+    best += itertools.islice(others, max - len(best))
+    return [entries[i] for i in best]
 
-    for score in high_score:
-        item = score[1]
-        result.append(item['url'])
+# Function to score and filter results based on query
+def search_description(search_result: list, query: str, max: int) -> list:
+    '''
+    Gets the urls of the top results
+    '''
+    result = [item['url'] for item in rank_entries(search_result, query, max)]
 
-    if not high_score:
+    if not result:
         result.append("No images found.")
 
     return result
 
-# Function to download images based on the filtered results
-def get_images(urls: list) -> None:
+# Function to rank a date range through the cache's index
+def rank_cached(start_date: str, end_date: str, query: str, cache, max: int = 2) -> list:
     '''
-    Grabs images from urls
+    Same as rank_entries on the range's entries, but scored from the
+    cache's persistent index
     '''
-    if len(urls) < 2:
-        raise AppError("Not enough images.")
+    max = _max_results(max)
+    dates = sync_dates(start_date, end_date, cache)
+    if not dates:
+        return []
+    best = cache.search(query, dates[0], dates[-1], max)
+    picked = set(best)
+    for i in range(0, len(dates), 64):
+        if len(best) >= max:
+            break
+        cached = cache.get_many([date for date in dates[i:i + 64] if date not in picked])
+        best += sorted(date for date, entry in cached.items() if entry is not None)
+    found = cache.get_many(best[:max])
+    return [found[date] for date in best[:max]]
+
+def search_cached(start_date: str, end_date: str, query: str, cache, max: int = 2) -> list:
+    '''
+    search_description for a date range, through the cache
+    '''
+    result = [item['url'] for item in rank_cached(start_date, end_date, query, cache, max)]
 
-    for i, url in enumerate(urls[:2], start=1):
-        try:
-            response = urllib.request.urlopen(url)
-            image_data = response.read()
-            filename = f"image{i}.jpg"
-            with open(filename, "wb") as file:
-                file.write(image_data)
-            print(f"{filename} saved.")
-        except (urllib.error.HTTPError) as e:
-            raise AppError(f"Failed to download image {i}: {e}") from e
-        except (urllib.error.URLError) as e:
-            raise AppError(f"Failed to download image {i}: {e}") from e
-        except IOError as e:
-            raise AppError(f"Error saving file image{i}.jpg") from e
+    if not result:
+        result.append("No images found.")
 
-# Function to apply transformations and return a list of transformed images
-def get_transforms(file1: str, file2: str) -> list:
+    return result
+
+def is_image_entry(entry: dict) -> bool:
     '''
-    List of 12 images
+    True unless the entry is a video or other non-image media
     '''
-    image1 = SimpleImage(file1)
-    image2 = SimpleImage(file2)
+    media_type = entry.get('media_type')
+    if media_type is not None:
+        return media_type == 'image'
+    path = urllib.parse.urlparse(entry.get('url', '')).path.lower()
+    return path.endswith(IMAGE_EXTENSIONS)
 
-    image1 = SimpleImage.shrink(image1, 5)
-    image2 = SimpleImage.shrink(image2, 5)
+def _copy_response(response, file, prefix: bytes = b''):
+    '''
+    Streams prefix, the part of a response body already read, and the
+    rest of the body into file. A body shorter than its Content-Length
+    raises http.client.IncompleteRead.
+    '''
+    file.write(prefix)
+    copied = len(prefix)
+    while True:
+        chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        file.write(chunk)
+        copied += len(chunk)
+    expected = response.headers.get('Content-Length')
+    if expected is not None and expected.isdigit() and copied < int(expected):
+        raise http.client.IncompleteRead(b'', int(expected) - copied)
+
+def _image_size(source) -> tuple:
+    '''
+    (width, height) from an image's header, given as a file name or its
+    first bytes, or None if the header is not all there
+    '''
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    try:
+        with Image.open(source) as image:
+            return image.size
+    except (IOError, SyntaxError):
+        return None
 
-    transforms = []
-    transforms.append(image1.copy())
+def _read_header(response) -> bytes:
+    '''
+    The first bytes of a response, up to where its image size is known
+    (or PROBE_BYTES)
+    '''
+    data = b''
+    while len(data) < PROBE_BYTES:
+        chunk = response.read(PROBE_CHUNK_SIZE)
+        if not chunk:
+            break
+        data += chunk
+        if _image_size(data) is not None:
+            break
+    metrics.current().count('probe_bytes', len(data))
+    return data
+
+def _too_small(size: tuple, min_size: tuple) -> bool:
+    '''
+    True if a known size is under min_size in either direction
+    '''
+    return size is not None and (size[0] < min_size[0] or size[1] < min_size[1])
 
-    gray = SimpleImage.grayscale(image1.copy())
-    transforms.append(gray)
+def _store_fetch(store, url: str) -> str:
+    '''
+    store.fetch(url), counting whether it downloaded
+    '''
+    downloads = store.downloads
+    filename = store.fetch(url)
+    if store.downloads == downloads:
+        metrics.current().count('image_cache_hits')
+    else:
+        metrics.current().count('image_bytes', os.path.getsize(filename))
+    return filename
 
-    sep = SimpleImage.sepia(image1.copy())
-    transforms.append(sep)
+def _store_upgrade(store, url: str, hdurl: str, min_size: tuple) -> str:
+    '''
+    Store path of the hdurl image if the url one is smaller than
+    min_size, else of the url image if it was downloaded to find out,
+    else None. The size comes from the stored url image, or from the
+    first bytes of its download, which the store then keeps. Stores
+    that never download, like an ApodArchive, have no put() and are
+    only asked what they hold. If the hdurl image cannot be had, the
+    result is None, so the url image is used.
+    '''
+    path = store.stored(url)
+    if path is not None:
+        if not _too_small(_image_size(path), min_size):
+            return None
+    elif hasattr(store, 'put'):
+        with urllib.request.urlopen(url) as response:
+            prefix = _read_header(response)
+            if not _too_small(_image_size(prefix), min_size):
+                path = store.put(url, response, prefix)
+                metrics.current().count('image_bytes', os.path.getsize(path))
+                return path
+    else:
+        return None
+    try:
+        return _store_fetch(store, hdurl)
+    except (urllib.error.URLError, http.client.HTTPException, ValueError) as e:
+        print(f"Keeping {url}: {e}")
+        return None
 
-    blurred = SimpleImage.blur(image1.copy())
-    transforms.append(blurred)
+def _fetch_image(url: str, filename: str = None, store=None,
+                 min_size: tuple = None, hdurl: str = None):
+    '''
+    Downloads one image and checks that it is one. Returns the store
+    path, else filename (streamed to disk), else the bytes if filename
+    is None. With min_size and an hdurl, an image at url smaller than
+    min_size is replaced by the hdurl one, unless that one fails. The
+    size comes from the first bytes of the url's download, which then
+    either carries on or stops, so url is only requested again if the
+    hdurl fails.
+    '''
+    upgrade = min_size is not None and hdurl not in (None, url)
+    try:
+        if store is not None:
+            filename = _store_upgrade(store, url, hdurl, min_size) if upgrade else None
+            if filename is None:
+                filename = _store_fetch(store, url)
+        else:
+            with urllib.request.urlopen(url) as response:
+                prefix = _read_header(response) if upgrade else b''
+                if upgrade and _too_small(_image_size(prefix), min_size):
+                    response.close()
+                    try:
+                        return _fetch_image(hdurl, filename)
+                    except AppError as e:
+                        print(f"Keeping {url}: {e}")
+                        return _fetch_image(url, filename)
+                if filename is None:
+                    buffer = io.BytesIO()
+                    _copy_response(response, buffer, prefix)
+                    filename = buffer.getbuffer()
+                    metrics.current().count('image_bytes', len(filename))
+                else:
+                    tmp_name = filename + '.part'
+                    try:
+                        with open(tmp_name, "wb") as file:
+                            _copy_response(response, file, prefix)
+                        os.replace(tmp_name, filename)
+                    finally:
+                        if os.path.exists(tmp_name):
+                            os.remove(tmp_name)
+                    metrics.current().count('image_bytes', os.path.getsize(filename))
+                    print(f"{filename} saved.")
+    except (urllib.error.URLError, http.client.HTTPException, ValueError) as e:
+        # ValueError: urlopen rejects the url, e.g. one without a scheme
+        raise AppError(f"Failed to download {url}: {e}") from e
+    except IOError as e:
+        raise AppError(f"Error saving file {filename}") from e
+    try:
+        source = io.BytesIO(filename) if isinstance(filename, memoryview) else filename
+        with Image.open(source):
+            pass
+    except (IOError, SyntaxError) as e:
+        if isinstance(filename, str) and store is None:
+            os.remove(filename)
+        raise AppError(f"Not an image: {url}") from e
+    return filename
+
+async def _download_images(entries: list, needed: int, directory: str, store,
+                           workers: int, min_size: tuple = None) -> list:
+    '''
+    Downloads needed entries at once, starting the next candidate
+    whenever one fails
+    '''
+    semaphore = asyncio.Semaphore(workers)
+    candidates = iter(enumerate(entries))
+    ranks = {}
+    results = {}
+
+    def fetch(entry, filename):
+        return _fetch_image(entry['url'], filename, store, min_size, entry.get('hdurl'))
+
+    async def download(entry, filename):
+        async with semaphore:
+            return await asyncio.to_thread(fetch, entry, filename)
+
+    def start_next():
+        for rank, entry in candidates:
+            filename = None
+            if directory is not None:
+                filename = os.path.join(directory, f"image{rank + 1}.jpg")
+            task = asyncio.ensure_future(download(entry, filename))
+            ranks[task] = rank
+            return task
+        return None
+
+    pending = {start_next() for _ in range(needed)} - {None}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            try:
+                results[ranks[task]] = task.result()
+            except AppError as e:
+                print(f"Skipping: {e}")
+                task = start_next()
+                if task is not None:
+                    pending.add(task)
+    return [results[rank] for rank in sorted(results)][:needed]
+
+# Function to download the best images among ranked candidates
+def download_images(entries: list, needed: int = 2, directory: str = None, store=None,
+                    workers: int = DOWNLOAD_WORKERS, min_size: tuple = None) -> list:
+    '''
+    Downloads the first needed images of entries concurrently. Videos
+    are skipped without downloading, and a failed download is replaced
+    by the next candidate. With min_size, an entry whose url image is
+    smaller than that is downloaded from its hdurl instead. Returns, in
+    rank order, the file names in directory (or the store), or the
+    image bytes as memoryviews if neither is given.
+    '''
+    entries = [entry for entry in entries if is_image_entry(entry)]
+    filenames = asyncio.run(_download_images(entries, needed, directory, store, workers,
+                                             min_size))
+    if len(filenames) < needed:
+        raise AppError("Not enough images.")
+    return filenames
 
-    red_filtered = SimpleImage.filter(image1.copy(), 'red', 100)
-    transforms.append(red_filtered)
+# Function to download images based on the filtered results
+def get_images(urls: list, directory: str = '.', store=None) -> list:
+    '''
+    Grabs the first two images from urls into directory, returns the
+    file names. With an ImageStore the images come from (and go to) the
+    store instead.
+    '''
+    if len(urls) < 2:
+        raise AppError("Not enough images.")
+    entries = [{'url': url, 'media_type': 'image'} for url in urls[:2]]
+    return download_images(entries, 2, directory, store)
 
-    green_filtered = SimpleImage.filter(image1.copy(), 'green', 100)
-    transforms.append(green_filtered)
+# sources with at least this many pixels are filtered a tile at a time,
+# so the filters' working memory stays bounded by simpleimage.TILE_SIZE
+TILED_MIN_PIXELS = 2048 * 2048
 
-    blue_filtered = SimpleImage.filter(image1.copy(), 'blue', 100)
-    transforms.append(blue_filtered)
 
-    flip_h = SimpleImage.flip(image1.copy(), 0)
-    transforms.append(flip_h)
+def run_filter(image: SimpleImage, name: str, *args) -> SimpleImage:
+    '''
+    The built-in filter name applied to image, tile by tile if the
+    image has TILED_MIN_PIXELS or more
+    '''
+    if image.width * image.height >= TILED_MIN_PIXELS:
+        return image.tiled(name, *args)
+    return getattr(SimpleImage, name)(image, *args)
 
-    flip_v = SimpleImage.flip(image1.copy(), 1)
-    transforms.append(flip_v)
 
-    greenscreen_red = SimpleImage.greenscreen(image1.copy(), 'red', 100, image2.copy())
-    transforms.append(greenscreen_red)
+class TransformSource:
+    '''
+    One decoded, shrunk image shared by every transform, plus the
+    intermediates several transforms need: the grayscale version and
+    the background already resized to match.
+    '''
+    def __init__(self, image: SimpleImage, background: SimpleImage, blur_radius: int = 1):
+        self.image = image
+        self.background = background
+        self.background.make_as_big_as(image)
+        self.blur_radius = blur_radius
+        self._gray = None
+        self._lock = threading.Lock()
+
+    @property
+    def gray(self) -> SimpleImage:
+        '''
+        Grayscale image, made the first time it is asked for
+        '''
+        with self._lock:
+            if self._gray is None:
+                self._gray = run_filter(self.image, 'grayscale')
+            return self._gray
+
+
+# The mosaic tiles in order, as (name, function of a TransformSource).
+# Filters return new images, so no stage needs its own copy of the source.
+TRANSFORM_STAGES = [
+    ('original', lambda src: src.image),
+    ('grayscale', lambda src: src.gray),
+    ('sepia', lambda src: run_filter(src.image, 'sepia')),
+    ('blur', lambda src: run_filter(src.image, 'blur', src.blur_radius)),
+    ('filter_red', lambda src: run_filter(src.image, 'filter', 'red', 100, src.gray)),
+    ('filter_green', lambda src: run_filter(src.image, 'filter', 'green', 100, src.gray)),
+    ('filter_blue', lambda src: run_filter(src.image, 'filter', 'blue', 100, src.gray)),
+    ('flip_horizontal', lambda src: SimpleImage.flip(src.image, 0)),
+    ('flip_vertical', lambda src: SimpleImage.flip(src.image, 1)),
+    ('greenscreen_red', lambda src: run_filter(src.image, 'greenscreen', 'red', 100, src.background)),
+    ('greenscreen_green', lambda src: run_filter(src.image, 'greenscreen', 'green', 100, src.background)),
+    ('greenscreen_blue', lambda src: run_filter(src.image, 'greenscreen', 'blue', 100, src.background)),
+]
+
+# stages whose result also depends on the background image
+BACKGROUND_STAGES = {'greenscreen_red', 'greenscreen_green', 'greenscreen_blue'}
+
+# factor the downloaded images are shrunk by before transforming
+SHRINK_SCALE = 5
+
+
+def run_transforms(source: TransformSource, stages: list = None) -> list:
+    '''
+    Evaluates each stage against the shared source
+    '''
+    if stages is None:
+        stages = TRANSFORM_STAGES
+    return [_render_stage(name, stage, source) for name, stage in stages]
 
-    greenscreen_green = SimpleImage.greenscreen(image1.copy(), 'green', 100, image2.copy())
-    transforms.append(greenscreen_green)
+def _render_stage(name: str, stage, source: TransformSource) -> SimpleImage:
+    '''
+    Runs one stage, recording its time and pixels
+    '''
+    with metrics.current().stage(f"transform.{name}"):
+        res = stage(source)
+    metrics.current().count('pixels_processed', res.width * res.height)
+    return res
 
-    greenscreen_blue = SimpleImage.greenscreen(image1.copy(), 'blue', 100, image2.copy())
-    transforms.append(greenscreen_blue)
 
-    return transforms
+class LazyTransforms:
+    '''
+    Sequence of transform results that renders each stage the first time
+    it is indexed and remembers it. compose() only picks some tiles, so
+    stages it never draws are never rendered. on_render(name) is called
+    each time a stage is rendered. Threads may share one: each stage
+    and the source are only ever made once.
+
+    With a TransformCache and one key per stage, a stage is looked up
+    in the cache before rendering and stored there after. source may
+    then be a function returning the TransformSource, which is only
+    called (decoding the images) if some stage is not cached.
+    '''
+    def __init__(self, source, stages: list = None, on_render=None,
+                 cache=None, keys: list = None):
+        if stages is None:
+            stages = TRANSFORM_STAGES
+        self._source = source
+        self.stages = stages
+        self.on_render = on_render
+        self.cache = cache
+        self.keys = keys
+        self._results = [None] * len(stages)
+        self._stage_locks = [threading.Lock() for _ in stages]
+        self._source_lock = threading.Lock()
+
+    @property
+    def source(self) -> TransformSource:
+        '''
+        The shared source, decoded the first time it is needed
+        '''
+        with self._source_lock:
+            if callable(self._source):
+                self._source = self._source()
+            return self._source
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __getitem__(self, index):
+        if self._results[index] is not None:
+            return self._results[index]
+        with self._stage_locks[index]:
+            if self._results[index] is None:
+                self._results[index] = self._render(index)
+            return self._results[index]
+
+    def _render(self, index) -> SimpleImage:
+        '''
+        Stage index from the cache, else rendered (and cached)
+        '''
+        name, stage = self.stages[index]
+        res = None
+        if self.cache is not None:
+            res = self.cache.get(self.keys[index])
+            metrics.current().count('transform_cache_hits' if res is not None
+                                    else 'transform_cache_misses')
+        if res is None:
+            res = _render_stage(name, stage, self.source)
+            if self.cache is not None:
+                self.cache.put(self.keys[index], res)
+            if self.on_render is not None:
+                self.on_render(name)
+        return res
+
+    @property
+    def materialized(self) -> list:
+        '''
+        Names of the stages rendered so far
+        '''
+        return [name for (name, _), res in zip(self.stages, self._results) if res is not None]
+
+    def stats(self) -> dict:
+        '''
+        How many stages were rendered out of the total
+        '''
+        return {'rendered': len(self.materialized), 'total': len(self.stages)}
+
+
+def transform_keys(image_hash: str, background_hash: str, params: tuple = (),
+                   stages: list = None, scale: int = SHRINK_SCALE) -> list:
+    '''
+    TransformCache key of each stage. Only the background stages depend
+    on the background, so the other tiles of an image are shared by
+    every pairing.
+    '''
+    if stages is None:
+        stages = TRANSFORM_STAGES
+    return [tile_key(image_hash, scale, name, params,
+                     background_hash if name in BACKGROUND_STAGES else None)
+            for name, _ in stages]
 
-# Function to compose the final 5x5 grid of images
-def compose(img_list: list) -> SimpleImage:
+# Function to apply transformations and return a list of transformed images
+def get_transforms(file1, file2, blur_radius: int = 1,
+                   resample: str = 'box', lazy: bool = False, cache=None):
+    '''
+    List of 12 images, or a LazyTransforms if lazy. The images may be
+    file names or encoded bytes. With a TransformCache, cached tiles are
+    reused and the images are only decoded if a tile is missing.
+    '''
+    def decode():
+        with metrics.current().stage('decode'):
+            image1 = SimpleImage.file_shrunk(file1, SHRINK_SCALE, resample)
+            image2 = SimpleImage.file_shrunk(file2, SHRINK_SCALE, resample)
+        return TransformSource(image1, image2, blur_radius)
+
+    if cache is None:
+        source = decode()
+        if lazy:
+            return LazyTransforms(source)
+        return run_transforms(source)
+    keys = transform_keys(content_hash(file1), content_hash(file2), (blur_radius, resample))
+    transforms = LazyTransforms(decode, cache=cache, keys=keys)
+    if lazy:
+        return transforms
+    return [transforms[i] for i in range(len(transforms))]
+
+# Function to compose the final grid of images (5x5 by default)
+def compose(img_list: list, rows: int = 5, cols: int = 5, spacing: int = 0,
+            rng: random.Random = None, back_color: str = None,
+            output="pop.jpg", encoding: dict = None) -> SimpleImage:
     '''
-    Creates the final image
+    Creates the final image. Each cell of the rows x cols grid gets a
+    random image from img_list, pasted as one block. spacing puts a gap of
+    back_color pixels between cells. Pass a seeded random.Random as rng
+    to get the same mosaic every time. The mosaic is written to output
+    (a file name or a binary stream) unless it is None, encoded with
+    encoding: keyword arguments of SimpleImage.encode, by default the
+    format of output's extension with Pillow's settings.
     '''
     if len(img_list) != 12:
         raise AppError("Needs to be exactly 12 images.")
+    if rng is None:
+        rng = random
     img = img_list[0]
-    canvas_width = img.width * 5
-    canvas_height = img.height * 5
-    res = SimpleImage.blank(canvas_width, canvas_height)
-
-    for col in range(5):
-        for row in range(5):
-            selected_images = random.choice(img_list)
-            for y in range(img.height):
-                for x in range(img.width):
-                    pix = selected_images.get_pixel(x, y)
-                    final_x = col * img.width + x
-                    final_y = row * img.height + y
-                    rpix = res.get_pixel(final_x, final_y)
-                    rpix.red = pix.red
-                    rpix.green = pix.green
-                    rpix.blue = pix.blue
-    res.write("pop.jpg")
+    canvas_width = img.width * cols + spacing * (cols - 1)
+    canvas_height = img.height * rows + spacing * (rows - 1)
+    res = SimpleImage.blank(canvas_width, canvas_height, back_color)
+
+    for col in range(cols):
+        for row in range(rows):
+            selected_images = rng.choice(img_list)
+            final_x = col * (img.width + spacing)
+            final_y = row * (img.height + spacing)
+            res.pil_image.paste(selected_images.pil_image, (final_x, final_y))
+    if output is not None:
+        encoding = dict(encoding or {})
+        encoding.setdefault('format', output_format(output))
+        stats = metrics.current()
+        with stats.stage('encode'):
+            data = res.encode(**encoding)
+        stats.count('encoded_bytes', len(data))
+        with stats.stage('write'):
+            write_bytes(output, data)
 
     return res
 
+# Function to run every stage for one query, without showing the result
+def render_mosaic(start_date: str, end_date: str, query: str,
+                  output: str = "pop.jpg", directory: str = None,
+                  rng: random.Random = None, cache=None, store=None,
+                  transform_cache=None, encoding: dict = None,
+                  min_tile: tuple = None) -> SimpleImage:
+    '''
+    Fetches, downloads, transforms and composes one mosaic.
+    With an ApodCache only uncached dates are fetched, with an
+    ImageStore only images not already stored are downloaded, and with
+    a TransformCache the tiles of images seen before are reused. Downloads
+    are decoded from memory unless a directory or store is given.
+    output and encoding are passed to compose. With min_tile (width,
+    height), an image whose tiles would be smaller than that is fetched
+    from its hdurl instead of its url.
+    '''
+    stats = metrics.current()
+    candidates = 2 + DOWNLOAD_SPARES
+    with stats.stage('search'):
+        if cache is not None:
+            top_results = rank_cached(start_date, end_date, query, cache, max=candidates)
+        else:
+            search_result = iter_result(start_date, end_date)
+            top_results = rank_entries(search_result, query, max=candidates)
+    with stats.stage('download'):
+        min_size = None
+        if min_tile is not None:
+            min_size = (min_tile[0] * SHRINK_SCALE, min_tile[1] * SHRINK_SCALE)
+        file1, file2 = download_images(top_results, 2, directory, store, min_size=min_size)
+    transforms = get_transforms(file1, file2, lazy=True, cache=transform_cache)
+    with stats.stage('compose'):
+        return compose(transforms, rng=rng, output=output, encoding=encoding)
+
 # Main function to run the complete process
-def run():
+def run(argv: list = None):
     '''
-    Main function
+    Main function. --metrics and --trace record per-stage timings and
+    counters to a JSON or Chrome trace file.
     '''
+    parser = argparse.ArgumentParser(description="Make a mosaic from NASA's picture of the day.")
+    parser.add_argument('--metrics', help="write stage timings and counters as JSON here")
+    parser.add_argument('--trace', help="write a Chrome trace (chrome://tracing) here")
+    args = parser.parse_args(argv)
+    stats = metrics.Metrics() if args.metrics or args.trace else metrics.NULL_METRICS
     try:
         start_date, end_date, query = get_input()
-        url = build_url(start_date, end_date)
-        search_result = get_result(url)
-        top_results = search_description(search_result, query, max=2)
-        get_images(top_results)
-        transforms = get_transforms("image1.jpg", "image2.jpg")
-        res = compose(transforms)
+        with metrics.activate(stats), ApodCache() as cache, ImageStore() as store:
+            res = render_mosaic(start_date, end_date, query, cache=cache, store=store)
+        if args.metrics:
+            stats.write_json(args.metrics)
+        if args.trace:
+            stats.write_chrome_trace(args.trace)
         res.show()
     except AppError as e:
         print(f"Error: {e}")
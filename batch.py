@@ -0,0 +1,215 @@
+'''
+Batch mode: renders one mosaic per line of a manifest across a process pool.
+
+The manifest is CSV (with a header row) or JSON lines, one job per line
+with start_date, end_date and query. Optional columns are output (the
+mosaic path), seed, cache (an ApodCache path; --cache sets it for
+every job), image_store (an ImageStore directory; --image-store) and
+transform_cache (a TransformCache directory; --transform-cache),
+archive (an ApodArchive directory used read-only as both cache and
+image store, so a node with a synced archive renders offline; --archive), and
+the encoding columns format, quality, optimize, progressive and
+compress_level (see SimpleImage.encode; --format and --quality set
+defaults), and min_tile, e.g. 200x150, to fetch an image from its
+hdurl when its url would give smaller tiles (--min-tile). Example:
+
+    python batch.py jobs.jsonl --out-dir mosaics --workers 8 --report report.json
+'''
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import json
+import os
+import random
+import sys
+import time
+import art
+from apod_archive import ApodArchive
+from apod_cache import ApodCache
+from image_store import ImageStore
+from transform_cache import TransformCache
+
+
+# manifest columns passed to SimpleImage.encode, with their parsers
+ENCODING_COLUMNS = {
+    'format': str.lower,
+    'quality': int,
+    'compress_level': int,
+    'optimize': lambda value: str(value).lower() in ('1', 'true', 'yes'),
+    'progressive': lambda value: str(value).lower() in ('1', 'true', 'yes'),
+}
+
+
+def read_manifest(path: str) -> list:
+    '''
+    Reads jobs from a .csv or .jsonl manifest
+    '''
+    with open(path, newline='') as file:
+        if path.endswith('.csv'):
+            jobs = [dict(row) for row in csv.DictReader(file)]
+        else:
+            jobs = [json.loads(line) for line in file if line.strip()]
+    for job in jobs:
+        for key in ('start_date', 'end_date', 'query'):
+            job.setdefault(key, '')
+    return jobs
+
+
+def assign_outputs(jobs: list, out_dir: str) -> list:
+    '''
+    Gives every job without an output its own numbered path in out_dir
+    '''
+    for i, job in enumerate(jobs):
+        if not job.get('output'):
+            ext = str(job.get('format') or 'jpg').lower()
+            job['output'] = os.path.join(out_dir, f"mosaic{i:04d}.{ext}")
+    return jobs
+
+
+def parse_tile(text: str) -> tuple:
+    '''
+    "200x150" -> (200, 150)
+    '''
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def job_encoding(job: dict) -> dict:
+    '''
+    The job's encoding columns as SimpleImage.encode arguments
+    '''
+    return {key: parse(job[key]) for key, parse in ENCODING_COLUMNS.items()
+            if job.get(key) not in (None, '')}
+
+
+# TransformCache per directory, kept for the life of the worker process
+# so its in-memory tiles carry over between jobs
+_transform_caches = {}
+
+
+def worker_transform_cache(directory: str) -> TransformCache:
+    '''
+    This process's TransformCache for directory
+    '''
+    if directory not in _transform_caches:
+        _transform_caches[directory] = TransformCache(directory)
+    return _transform_caches[directory]
+
+
+def render_job(job: dict) -> dict:
+    '''
+    Renders one job in a worker process. Errors are reported in the
+    result instead of raised, so one bad job does not stop the batch.
+    '''
+    start = time.perf_counter()
+    result = {'output': job['output'], 'query': job['query']}
+    try:
+        rng = None
+        if job.get('seed') not in (None, ''):
+            rng = random.Random(int(job['seed']))
+        with contextlib.ExitStack() as stack:
+            cache = None
+            if job.get('cache'):
+                cache = stack.enter_context(ApodCache(job['cache']))
+            store = None
+            if job.get('image_store'):
+                store = stack.enter_context(ImageStore(job['image_store']))
+            if job.get('archive'):
+                cache = store = stack.enter_context(ApodArchive(job['archive'], read_only=True))
+            transform_cache = None
+            if job.get('transform_cache'):
+                transform_cache = worker_transform_cache(job['transform_cache'])
+            art.render_mosaic(job['start_date'], job['end_date'], job['query'],
+                              output=job['output'], rng=rng, cache=cache, store=store,
+                              transform_cache=transform_cache, encoding=job_encoding(job),
+                              min_tile=parse_tile(job['min_tile']) if job.get('min_tile') else None)
+        result['ok'] = True
+    except Exception as e:  # pylint: disable=broad-except
+        result['ok'] = False
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def run_batch(jobs: list, workers: int = None, render=render_job) -> dict:
+    '''
+    Renders all jobs across a process pool and returns a summary report
+    '''
+    start = time.perf_counter()
+    results = [None] * len(jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(render, job): i for i, job in enumerate(jobs)}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                # the worker itself died, e.g. BrokenProcessPool
+                results[i] = {'output': jobs[i].get('output'), 'query': jobs[i].get('query'),
+                              'ok': False, 'error': f"{type(e).__name__}: {e}"}
+    elapsed = time.perf_counter() - start
+    succeeded = sum(1 for res in results if res['ok'])
+    return {
+        'jobs': len(jobs),
+        'succeeded': succeeded,
+        'failed': len(jobs) - succeeded,
+        'seconds': elapsed,
+        'mosaics_per_sec': succeeded / elapsed if elapsed else 0.0,
+        'results': results,
+    }
+
+
+def main(argv: list = None):
+    '''
+    Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description="Render APOD mosaics in parallel.")
+    parser.add_argument('manifest', help="CSV or JSONL file of start_date, end_date, query")
+    parser.add_argument('--out-dir', default='mosaics', help="where mosaics without an output go")
+    parser.add_argument('--workers', type=int, default=None, help="processes (default: CPU count)")
+    parser.add_argument('--cache', help="ApodCache path shared by all jobs")
+    parser.add_argument('--image-store', help="ImageStore directory shared by all jobs")
+    parser.add_argument('--transform-cache', help="TransformCache directory shared by all jobs")
+    parser.add_argument('--archive', help="ApodArchive directory to render from offline")
+    parser.add_argument('--format', help="default output format: jpeg, png, webp or raw")
+    parser.add_argument('--quality', type=int, help="default JPEG / WebP quality")
+    parser.add_argument('--min-tile', help="smallest tile size, e.g. 200x150")
+    parser.add_argument('--report', help="also write the summary as JSON to this path")
+    args = parser.parse_args(argv)
+
+    jobs = read_manifest(args.manifest)
+    for job in jobs:
+        if args.format:
+            job.setdefault('format', args.format)
+        if args.quality is not None:
+            job.setdefault('quality', args.quality)
+        if args.min_tile:
+            job.setdefault('min_tile', args.min_tile)
+    assign_outputs(jobs, args.out_dir)
+    for job in jobs:
+        if args.cache:
+            job.setdefault('cache', args.cache)
+        if args.image_store:
+            job.setdefault('image_store', args.image_store)
+        if args.transform_cache:
+            job.setdefault('transform_cache', args.transform_cache)
+        if args.archive:
+            job.setdefault('archive', args.archive)
+    os.makedirs(args.out_dir, exist_ok=True)
+    report = run_batch(jobs, args.workers)
+
+    for res in report['results']:
+        if not res['ok']:
+            print(f"FAILED {res['output']}: {res['error']}")
+    print(f"{report['succeeded']}/{report['jobs']} mosaics in {report['seconds']:.1f}s "
+          f"({report['mosaics_per_sec']:.2f} mosaics/sec)")
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file, indent=2)
+    if report['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
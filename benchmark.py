@@ -0,0 +1,209 @@
+'''
+Benchmarks for every SimpleImage operation and the art pipeline stages.
+
+Image operations run on random images of each size in SIZES. Network
+stages run against a local FakeApodServer, so timings do not depend on
+NASA. Results are written as JSON and can be checked against an earlier
+run:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json   # exits 1 on a regression
+'''
+import argparse
+import datetime
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import PIL
+from PIL import Image
+import art
+import simpleimage
+from fake_apod import FakeApodServer, fake_entry
+from simpleimage import SimpleImage
+
+
+SIZES = [(128, 96), (512, 384), (1024, 768)]
+
+# a benchmark is this much slower than its baseline before it counts as a regression
+TOLERANCE = 0.25
+
+# name -> function of (image, background), for each SimpleImage operation
+IMAGE_BENCHMARKS = {
+    'copy': lambda image, background: image.copy(),
+    'grayscale': lambda image, background: image.grayscale(),
+    'sepia': lambda image, background: image.sepia(),
+    'blur': lambda image, background: image.blur(),
+    'shrink': lambda image, background: image.shrink(5),
+    'flip': lambda image, background: image.flip(0),
+    'filter': lambda image, background: image.filter('red', 100),
+    'greenscreen': lambda image, background: image.greenscreen('red', 100, background),
+    'encode_jpeg': lambda image, background: image.encode('jpeg'),
+    'encode_png': lambda image, background: image.encode('png', compress_level=1),
+    'encode_webp': lambda image, background: image.encode('webp'),
+}
+
+# benchmarks that resize their background in place, so each run gets a
+# fresh copy, made outside the timing
+RESIZES_BACKGROUND = {'greenscreen'}
+
+
+def synthetic_image(width: int, height: int, seed: int = 0) -> SimpleImage:
+    '''
+    Image of random pixels
+    '''
+    data = random.Random(seed).randbytes(width * height * 3)
+    return SimpleImage.from_pil(Image.frombytes('RGB', (width, height), data))
+
+
+def time_call(func, repeat: int, setup=None) -> dict:
+    '''
+    Runs func repeat times, returns min / median / mean seconds. If
+    given, setup() runs untimed before each call and func gets its result.
+    '''
+    times = []
+    for _ in range(repeat):
+        args = (setup(),) if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times)}
+
+
+def bench_images(sizes: list, repeat: int, names: list = None) -> dict:
+    '''
+    Times each SimpleImage operation at each size
+    '''
+    results = {}
+    for width, height in sizes:
+        image = synthetic_image(width, height)
+        background = synthetic_image(width // 2, height // 2, seed=1)
+        for name, func in IMAGE_BENCHMARKS.items():
+            if names and name not in names:
+                continue
+            if name in RESIZES_BACKGROUND:
+                timing = time_call(lambda bg: func(image, bg), repeat, background.copy)
+            else:
+                timing = time_call(lambda: func(image, background), repeat)
+            results[f"simpleimage.{name}@{width}x{height}"] = timing
+    return results
+
+
+def bench_art(sizes: list, repeat: int, corpus_days: int = 3650) -> dict:
+    '''
+    Times the art pipeline stages, with network stages on a fake API
+    '''
+    results = {}
+    start = datetime.date(2000, 1, 1)
+    corpus = [fake_entry((start + datetime.timedelta(days=i)).isoformat())
+              for i in range(corpus_days)]
+    results[f"art.search_description@{corpus_days}"] = time_call(
+        lambda: art.search_description(corpus, 'moon nebula', 2), repeat)
+
+    for width, height in sizes:
+        label = f"{width}x{height}"
+        data1 = synthetic_image(width, height).encode()
+        data2 = synthetic_image(width, height, seed=1).encode()
+        results[f"art.get_transforms@{label}"] = time_call(
+            lambda: art.get_transforms(data1, data2), repeat)
+        transforms = art.get_transforms(data1, data2)
+        results[f"art.compose@{label}"] = time_call(
+            lambda: art.compose(transforms, rng=random.Random(0), output=None), repeat)
+
+    with FakeApodServer() as server:
+        old_url = art.BASE_NASA_URL
+        art.BASE_NASA_URL = server.url
+        try:
+            results['art.get_result@31'] = time_call(
+                lambda: art.get_result(art.build_url('2024-01-01', '2024-01-31')), repeat)
+            results['art.iter_result@365'] = time_call(
+                lambda: list(art.iter_result('2023-01-01', '2023-12-31')), repeat)
+            server.image_size = sizes[-1]
+            entries = [{'url': f"{server.base}/image/{i}.jpg"} for i in range(2)]
+            results[f"art.download_images@{sizes[-1][0]}x{sizes[-1][1]}"] = time_call(
+                lambda: art.download_images(entries, 2), repeat)
+        finally:
+            art.BASE_NASA_URL = old_url
+    return results
+
+
+def run_benchmarks(sizes: list = None, repeat: int = 3, names: list = None,
+                   corpus_days: int = 3650) -> dict:
+    '''
+    Runs every benchmark, returns the JSON-ready report
+    '''
+    if sizes is None:
+        sizes = SIZES
+    results = bench_images(sizes, repeat, names)
+    if not names or 'art' in names:
+        results.update(bench_art(sizes, repeat, corpus_days))
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'numpy': simpleimage.np.__version__ if simpleimage.np is not None else None,
+            'array_backed': simpleimage.ARRAY_BACKED,
+            'repeat': repeat,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float = TOLERANCE) -> list:
+    '''
+    Benchmarks whose median got more than tolerance slower than the
+    baseline, as (name, baseline seconds, new seconds)
+    '''
+    regressions = []
+    for name, timing in report['results'].items():
+        old = baseline['results'].get(name)
+        if old and timing['median'] > old['median'] * (1 + tolerance):
+            regressions.append((name, old['median'], timing['median']))
+    return regressions
+
+
+def parse_size(text: str) -> tuple:
+    '''
+    "640x480" -> (640, 480)
+    '''
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def main(argv: list = None):
+    '''
+    Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark SimpleImage and the art pipeline.")
+    parser.add_argument('--sizes', nargs='+', type=parse_size, help="image sizes, e.g. 640x480")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+',
+                        help="operations to run, from: " + ' '.join(IMAGE_BENCHMARKS) + ' art')
+    parser.add_argument('--output', help="write the JSON report here (default: stdout)")
+    parser.add_argument('--baseline', help="JSON report to compare against")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.sizes, args.repeat, args.only)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(report, baseline, args.tolerance)
+        for name, old, new in regressions:
+            print(f"REGRESSION {name}: {old * 1000:.1f}ms -> {new * 1000:.1f}ms", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
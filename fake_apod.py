@@ -0,0 +1,186 @@
+'''
+Local stand-in for the NASA APOD API, for tests and benchmarks.
+
+    with FakeApodServer() as server:
+        art.BASE_NASA_URL = server.url
+        ...
+
+Every date has a made-up entry whose explanation is drawn from WORDS,
+so the same date always gives the same entry.
+'''
+import datetime
+import hashlib
+import http.server
+import io
+import json
+import random
+import threading
+import urllib.parse
+from PIL import Image
+
+
+WORDS = ['moon', 'stars', 'galaxy', 'nebula', 'planet', 'comet', 'sun', 'eclipse',
+         'aurora', 'cluster', 'dust', 'light', 'sky', 'telescope', 'orbit', 'mars']
+
+
+def fake_entry(date: str, base: str = 'http://127.0.0.1') -> dict:
+    '''
+    Made-up APOD entry for a date
+    '''
+    rng = random.Random(date)
+    words = [rng.choice(WORDS) for _ in range(40)]
+    return {
+        'date': date,
+        'title': ' '.join(words[:3]).title(),
+        'explanation': ' '.join(words) + '.',
+        'media_type': 'image',
+        'url': f"{base}/image/{date}.jpg",
+        'hdurl': f"{base}/image/{date}-hd.jpg",
+    }
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    '''
+    Answers APOD queries from the server's entries
+    '''
+    def do_GET(self):  # pylint: disable=invalid-name
+        server = self.server.apod
+        parsed = urllib.parse.urlparse(self.path)
+        with server.lock:
+            server.requests.append(self.path)
+            failing = server.fail_next > 0
+            if failing:
+                server.fail_next -= 1
+        if failing:
+            self.send_error(503)
+            return
+        if parsed.path.startswith('/image/'):
+            self._send_image(server, parsed.path[len('/image/'):])
+            return
+        if parsed.path != '/planetary/apod':
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(parsed.query)
+        try:
+            start = datetime.date.fromisoformat(query['start_date'][0])
+            end = datetime.date.fromisoformat(query['end_date'][0])
+        except (KeyError, ValueError):
+            self.send_error(400)
+            return
+        entries = []
+        day = start
+        while day <= end:
+            entry = server.entry(day.isoformat())
+            if entry is not None:
+                entries.append(entry)
+            day += datetime.timedelta(days=1)
+        body = json.dumps(entries).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_image(self, server, name):
+        body = server.image(name)
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if name in server.truncated:
+            # promise the whole body but hang up halfway through
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+        with server.lock:
+            server.bytes_sent += len(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class FakeApodServer:
+    '''
+    Threaded HTTP server on a free local port. entries maps a date to
+    its entry (or None for a day with no picture); other dates get
+    fake_entry(). requests records every path asked for. The next
+    fail_next requests get a 503. /image/<name> serves a JPEG of
+    image_size pixels whose colour depends on name, hd_scale times
+    bigger if name ends in -hd.jpg. Names in truncated are cut off
+    halfway. bytes_sent counts the image bytes served.
+    '''
+    def __init__(self, entries: dict = None):
+        self.entries = entries or {}
+        self.requests = []
+        self.fail_next = 0
+        self.image_size = (200, 150)
+        self.hd_scale = 4
+        self.bytes_sent = 0
+        self.truncated = set()
+        self._images = {}
+        self.lock = threading.Lock()
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._httpd.apod = self
+        self._thread = None
+
+    @property
+    def base(self) -> str:
+        '''
+        http://host:port of the server
+        '''
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def url(self) -> str:
+        '''
+        Stand-in for art.BASE_NASA_URL
+        '''
+        return f"{self.base}/planetary/apod"
+
+    def entry(self, date: str):
+        '''
+        Entry served for a date
+        '''
+        if date in self.entries:
+            return self.entries[date]
+        return fake_entry(date, self.base)
+
+    def image(self, name: str) -> bytes:
+        '''
+        JPEG bytes served for an image name
+        '''
+        with self.lock:
+            size = self.image_size
+            if name.endswith('-hd.jpg'):
+                size = (size[0] * self.hd_scale, size[1] * self.hd_scale)
+            key = (name, size)
+            if key not in self._images:
+                rng = random.Random(name)
+                color = tuple(rng.randrange(256) for _ in range(3))
+                buffer = io.BytesIO()
+                Image.new('RGB', size, color).save(buffer, 'JPEG')
+                self._images[key] = buffer.getvalue()
+            return self._images[key]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, args=(0.05,),
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
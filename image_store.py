@@ -0,0 +1,204 @@
+'''
+Content-addressed store for downloaded images.
+
+Each image is kept once under the SHA-256 of its bytes, and an SQLite
+index maps every URL to its blob along with the ETag and Last-Modified
+the server sent. A stored URL is reused without any request for max_age
+seconds, then revalidated with If-None-Match / If-Modified-Since.
+Blobs are written to a temp file and renamed into place, so concurrent
+runs never see a half-written image. When the blobs add up to more than
+max_bytes, the least recently used ones are removed.
+'''
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from apod_cache import DEFAULT_CACHE_DIR
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageStore:
+    '''
+    URL -> local image file cache
+    '''
+    def __init__(self, directory: str = None, max_bytes: int = 512 * 1024 * 1024,
+                 max_age: float = 24 * 3600):
+        if directory is None:
+            directory = os.path.join(DEFAULT_CACHE_DIR, 'images')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.downloads = 0
+        self.hits = 0
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        # fetch() may be called from several download threads at once
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(directory, 'index.sqlite'), timeout=30,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS images '
+                         '(url TEXT PRIMARY KEY, digest TEXT, size INTEGER, etag TEXT, '
+                         'last_modified TEXT, checked_at REAL, used_at REAL)')
+        self._db.commit()
+
+    def path_for(self, digest: str) -> str:
+        '''
+        File holding the blob with this digest
+        '''
+        return os.path.join(self.directory, 'objects', digest)
+
+    def stored(self, url: str) -> str:
+        '''
+        Local path of url if it is stored, else None. Nothing is
+        downloaded or revalidated.
+        '''
+        with self._lock:
+            row = self._lookup(url)
+        return self.path_for(row[0]) if row is not None else None
+
+    def _lookup(self, url: str):
+        row = self._db.execute('SELECT digest, etag, last_modified, checked_at '
+                               'FROM images WHERE url = ?', (url,)).fetchone()
+        if row is None or not os.path.exists(self.path_for(row[0])):
+            return None
+        return row
+
+    def fetch(self, url: str) -> str:
+        '''
+        Local path of the image at url, downloading it only if it is
+        not stored or the server says it changed
+        '''
+        with self._lock:
+            row = self._lookup(url)
+        now = time.time()
+        if row is not None and now - row[3] < self.max_age:
+            return self._hit(url, row[0], now, checked=False)
+
+        request = urllib.request.Request(url)
+        if row is not None:
+            if row[1]:
+                request.add_header('If-None-Match', row[1])
+            if row[2]:
+                request.add_header('If-Modified-Since', row[2])
+        try:
+            with urllib.request.urlopen(request) as response:
+                return self.put(url, response)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and row is not None:
+                return self._hit(url, row[0], now, checked=True)
+            raise
+        except urllib.error.URLError:
+            if row is not None:
+                # offline: the stored copy is better than nothing
+                return self._hit(url, row[0], now, checked=False)
+            raise
+
+    def put(self, url: str, response, prefix: bytes = b'') -> str:
+        '''
+        Stores the image at url from an open response, of which prefix
+        was already read, and returns its local path
+        '''
+        digest, size = self._write_blob(response, prefix)
+        headers = response.headers
+        now = time.time()
+        with self._lock:
+            self.downloads += 1
+            old = self._db.execute('SELECT digest FROM images WHERE url = ?', (url,)).fetchone()
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (url, digest, size, headers.get('ETag'),
+                                  headers.get('Last-Modified'), now, now))
+            if old is not None and old[0] != digest:
+                self._release(old[0])
+            self._evict()
+        return self.path_for(digest)
+
+    def _hit(self, url: str, digest: str, now: float, checked: bool) -> str:
+        with self._lock, self._db:
+            self.hits += 1
+            if checked:
+                self._db.execute('UPDATE images SET used_at = ?, checked_at = ? WHERE url = ?',
+                                 (now, now, url))
+            else:
+                self._db.execute('UPDATE images SET used_at = ? WHERE url = ?', (now, url))
+        return self.path_for(digest)
+
+    def _write_blob(self, response, prefix: bytes = b'') -> tuple:
+        '''
+        Streams prefix and the rest of a response into the store,
+        returns (digest, size)
+        '''
+        digest = hashlib.sha256(prefix)
+        size = len(prefix)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.directory, 'objects'),
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(prefix)
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, self.path_for(digest.hexdigest()))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest.hexdigest(), size
+
+    def total_bytes(self) -> int:
+        '''
+        Size of all stored blobs
+        '''
+        with self._lock:
+            rows = self._db.execute('SELECT digest, MAX(size) FROM images GROUP BY digest')
+            return sum(size for _, size in rows)
+
+    def evict(self):
+        '''
+        Removes least recently used blobs until under max_bytes
+        '''
+        with self._lock:
+            self._evict()
+
+    def _release(self, digest: str):
+        '''
+        Removes the blob with this digest if no URL refers to it any more
+        '''
+        if self._db.execute('SELECT 1 FROM images WHERE digest = ?', (digest,)).fetchone():
+            return
+        try:
+            os.remove(self.path_for(digest))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        rows = self._db.execute('SELECT digest, MAX(size), MAX(used_at) FROM images '
+                                'GROUP BY digest ORDER BY MAX(used_at)').fetchall()
+        total = sum(size for _, size, _ in rows)
+        # the most recently used blob always stays
+        for digest, size, _ in rows[:-1]:
+            if total <= self.max_bytes:
+                break
+            with self._db:
+                self._db.execute('DELETE FROM images WHERE digest = ?', (digest,))
+            self._release(digest)
+            total -= size
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
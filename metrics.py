@@ -0,0 +1,152 @@
+'''
+Per-stage timing and counters for the art pipeline.
+
+Code being measured asks current() for the active Metrics and calls
+stage() / count() on it. When nothing is being measured current() is a
+NullMetrics whose methods do nothing, so the cost of the hooks is one
+function call each.
+
+    with metrics.activate(Metrics()) as m:
+        art.render_mosaic(...)
+    m.write_chrome_trace('trace.json')   # open in chrome://tracing or Perfetto
+'''
+import contextlib
+import json
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss() -> int:
+    '''
+    Peak resident memory of this process so far, in bytes (0 if unknown)
+    '''
+    if resource is None:
+        return 0
+    # ru_maxrss is kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Metrics:
+    '''
+    Stage timings and named counters for one run
+    '''
+    def __init__(self):
+        self.stages = []
+        self.counters = {}
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        '''
+        Times the with block as a stage called name
+        '''
+        start = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            record = {
+                'name': name,
+                'start': start - self._origin,
+                'wall': time.perf_counter() - start,
+                'cpu': time.process_time() - cpu,
+                'peak_rss': peak_rss(),
+                'thread': threading.get_ident(),
+            }
+            with self._lock:
+                self.stages.append(record)
+
+    def count(self, name: str, amount: int = 1):
+        '''
+        Adds amount to the counter called name
+        '''
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_dict(self) -> dict:
+        '''
+        Stages, per-name totals, counters and peak memory
+        '''
+        totals = {}
+        for record in self.stages:
+            total = totals.setdefault(record['name'], {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            total['wall'] += record['wall']
+            total['cpu'] += record['cpu']
+            total['calls'] += 1
+        return {
+            'stages': list(self.stages),
+            'totals': totals,
+            'counters': dict(self.counters),
+            'peak_rss': peak_rss(),
+        }
+
+    def write_json(self, path: str):
+        '''
+        Writes to_dict() as JSON
+        '''
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    def write_chrome_trace(self, path: str):
+        '''
+        Writes the stages in Chrome trace event format
+        '''
+        pid = os.getpid()
+        events = [{
+            'name': record['name'],
+            'ph': 'X',
+            'ts': record['start'] * 1e6,
+            'dur': record['wall'] * 1e6,
+            'pid': pid,
+            'tid': record['thread'],
+            'args': {'cpu_ms': record['cpu'] * 1e3, 'peak_rss': record['peak_rss']},
+        } for record in self.stages]
+        end = max((r['start'] + r['wall'] for r in self.stages), default=0)
+        events.append({'name': 'counters', 'ph': 'C', 'ts': end * 1e6, 'pid': pid,
+                       'args': dict(self.counters)})
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events}, file)
+
+
+class NullMetrics:
+    '''
+    Stand-in that records nothing
+    '''
+    def stage(self, name: str):  # pylint: disable=unused-argument
+        return _NULL_CONTEXT
+
+    def count(self, name: str, amount: int = 1):
+        pass
+
+
+_NULL_CONTEXT = contextlib.nullcontext()
+NULL_METRICS = NullMetrics()
+_current = NULL_METRICS
+
+
+def current():
+    '''
+    The Metrics being recorded into, or NULL_METRICS
+    '''
+    return _current
+
+
+@contextlib.contextmanager
+def activate(metrics: Metrics):
+    '''
+    Makes metrics current() for the with block
+    '''
+    global _current  # pylint: disable=global-statement
+    previous = _current
+    _current = metrics
+    try:
+        yield metrics
+    finally:
+        _current = previous
@@ -1,14 +1,47 @@
 '''
 Unit testing
 '''
+import concurrent.futures
+import datetime
+import io
+import json
+import os
+import random
+import tempfile
+import threading
 import unittest
-from simpleimage import SimpleImage
+import urllib.request
+import art
+import batch
+import benchmark
+import metrics
+import service
+import transform_cache
+from apod_archive import ApodArchive
+from apod_cache import ApodCache
+from fake_apod import FakeApodServer
+from image_store import ImageStore
+from search_index import InvertedIndex, top_k
+from transform_cache import TransformCache
+import simpleimage
+from simpleimage import ColorTransform, GRAYSCALE, SEPIA, SimpleImage
 from art import (
     AppError,
     build_url,
+    download_images,
+    render_mosaic,
+    search_cached,
+    chunk_ranges,
+    get_result,
+    iter_result,
+    get_cached_result,
     search_description,
     get_transforms,
     compose,
+    LazyTransforms,
+    run_transforms,
+    TransformSource,
+    TRANSFORM_STAGES,
     NASA_API_KEY,
 )
 
@@ -43,7 +76,21 @@ class TestArt(unittest.TestCase):
         ]
         query = 'moon'
         result = search_description(search_result, query, 2)
-        self.assertEqual(result, ['url1', 'url2'])
+        # BM25 ranks the shorter explanation first
+        self.assertEqual(result, ['url2', 'url1'])
+
+    def test_search_description_whole_words(self):
+        '''
+        Words match whole, titles count and unmatched entries fill in
+        '''
+        search_result = [
+            {'explanation': 'Moonlight over the sea.', 'url': 'url1'},
+            {'explanation': 'The Moon, rising.', 'url': 'url2'},
+            {'title': 'Moon and Mars', 'explanation': 'A pair of worlds.', 'url': 'url3'},
+        ]
+        result = search_description(search_result, 'moon', 3)
+        self.assertEqual(sorted(result[:2]), ['url2', 'url3'])
+        self.assertEqual(result[2], 'url1')
 
     def test_search_description_no_matches(self):
         '''
@@ -60,19 +107,85 @@ class TestArt(unittest.TestCase):
         '''
         image1 = SimpleImage.blank(100, 100)
         image2 = SimpleImage.blank(100, 100)
-        image1.write('image1.jpg')
-        image2.write('image2.jpg')
-        transforms = get_transforms('image1.jpg', 'image2.jpg')
+        transforms = get_transforms(image1.encode(), image2.encode())
         self.assertEqual(len(transforms), 12)
 
+    def test_run_transforms(self):
+        '''
+        Shared-source pipeline matches the filters run one by one
+        '''
+        image = noise_image(20, 15)
+        background = noise_image(30, 10, seed=1)
+        transforms = run_transforms(TransformSource(image, background.copy()))
+        names = [name for name, _ in TRANSFORM_STAGES]
+        self.assertEqual(len(transforms), 12)
+        expected = {
+            'grayscale': image.grayscale(),
+            'filter_blue': image.filter('blue', 100),
+            'greenscreen_green': image.greenscreen('green', 100, background.copy()),
+        }
+        for name, want in expected.items():
+            self.assertTrue(same_pixels(transforms[names.index(name)], want))
+
+    def test_tiled_transforms(self):
+        '''
+        Sources past TILED_MIN_PIXELS give the same tiles as whole filters
+        '''
+        image = noise_image(40, 30)
+        background = noise_image(30, 10, seed=1)
+        whole = run_transforms(TransformSource(image, background.copy(), 2))
+        old = art.TILED_MIN_PIXELS
+        try:
+            art.TILED_MIN_PIXELS = 40 * 30
+            tiled = run_transforms(TransformSource(image, background.copy(), 2))
+        finally:
+            art.TILED_MIN_PIXELS = old
+        for (name, _), a, b in zip(TRANSFORM_STAGES, whole, tiled):
+            self.assertEqual(a.pil_image.tobytes(), b.pil_image.tobytes(), name)
+
+    def test_lazy_transforms(self):
+        '''
+        Lazy transforms render only what compose picks
+        '''
+        source = TransformSource(noise_image(6, 5), noise_image(6, 5, seed=1))
+        rendered = []
+        lazy = LazyTransforms(source, on_render=rendered.append)
+        self.assertEqual(lazy.stats(), {'rendered': 0, 'total': 12})
+        compose(lazy, rows=1, cols=2, rng=random.Random(3), output=None)
+        self.assertEqual(sorted(lazy.materialized), sorted(rendered))
+        self.assertLessEqual(len(rendered), 3)
+        first = lazy[5]
+        self.assertIs(lazy[5], first)
+        self.assertEqual(rendered.count(TRANSFORM_STAGES[5][0]), 1)
+
     def test_compose(self):
         '''
         Compose test
         '''
         images = [SimpleImage.blank(10, 10) for i in range(12)]
-        result = compose(images)
+        output = io.BytesIO()
+        result = compose(images, output=output)
         self.assertEqual(result.width, 50)
         self.assertEqual(result.height, 50)
+        self.assertEqual(SimpleImage(output.getvalue()).width, 50)
+
+    def test_compose_grid(self):
+        '''
+        Grid size, spacing and seeded compose test
+        '''
+        colors = ['white', 'black', 'red', 'green', 'blue'] * 3
+        images = [SimpleImage.blank(10, 8, color) for color in colors[:12]]
+        result = compose(images, rows=2, cols=3, spacing=4,
+                         rng=random.Random(7), back_color='black', output=None)
+        self.assertEqual(result.width, 38)
+        self.assertEqual(result.height, 20)
+        again = compose(images, rows=2, cols=3, spacing=4,
+                        rng=random.Random(7), back_color='black', output=None)
+        self.assertTrue(same_pixels(result, again))
+        rng = random.Random(7)
+        first = rng.choice(images)
+        self.assertEqual(result._get_pix_(9, 7), first._get_pix_(0, 0))
+        self.assertEqual(result._get_pix_(11, 0), (0, 0, 0))
 
     def test_compose_incorrect_length(self):
         '''
@@ -82,6 +195,974 @@ class TestArt(unittest.TestCase):
         with self.assertRaises(AppError):
             compose(images)
 
+class FakeApodTestCase(unittest.TestCase):
+    '''
+    Points art at a local fake APOD server
+    '''
+    def setUp(self):
+        self.server = FakeApodServer().start()
+        self.addCleanup(self.server.stop)
+        old_url = art.BASE_NASA_URL
+        art.BASE_NASA_URL = self.server.url
+        self.addCleanup(setattr, art, 'BASE_NASA_URL', old_url)
+
+
+class TestApodCache(FakeApodTestCase):
+    '''
+    Date cache test class
+    '''
+    def test_fetches_only_missing_dates(self):
+        '''
+        Overlapping ranges only request uncached dates
+        '''
+        self.server.entries['2024-01-03'] = None
+        with ApodCache(':memory:') as cache:
+            first = get_cached_result('2024-01-01', '2024-01-05', cache)
+            self.assertEqual([e['date'] for e in first],
+                             ['2024-01-01', '2024-01-02', '2024-01-04', '2024-01-05'])
+            again = get_cached_result('2024-01-02', '2024-01-07', cache)
+            self.assertEqual(len(again), 5)
+            get_cached_result('2024-01-01', '2024-01-07', cache)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIn('start_date=2024-01-06&end_date=2024-01-07', self.server.requests[1])
+
+    def test_search_cached(self):
+        '''
+        The persistent index ranks like the in-memory search
+        '''
+        with ApodCache(':memory:') as cache:
+            entries = get_cached_result('2024-01-01', '2024-02-29', cache)
+            for query in ('moon', 'nebula comet', 'zzz'):
+                self.assertEqual(search_cached('2024-01-01', '2024-02-29', query, cache, 3),
+                                 search_description(entries, query, 3))
+            # narrower ranges only search their own dates
+            result = search_cached('2024-01-10', '2024-01-12', 'moon', cache, 2)
+            self.assertTrue(all('2024-01-1' in url for url in result))
+            # a range that ends before it starts has nothing in it
+            self.assertEqual(search_cached('2024-01-12', '2024-01-10', 'moon', cache, 2),
+                             ['No images found.'])
+
+    def test_search_range_statistics(self):
+        '''
+        Ranking a range ignores the other dates in the cache
+        '''
+        with ApodCache(':memory:') as cache:
+            get_cached_result('2023-10-01', '2024-03-31', cache)
+            for first, last in (('2023-10-05', '2023-10-14'), ('2024-01-01', '2024-01-10'),
+                                ('2024-02-20', '2024-03-01')):
+                entries = get_cached_result(first, last, cache)
+                for query in ('moon', 'nebula comet', 'sun sky orbit'):
+                    self.assertEqual(search_cached(first, last, query, cache, 4),
+                                     search_description(entries, query, 4))
+
+    def test_recent_dates_expire(self):
+        '''
+        Dates near today are refetched after the ttl
+        '''
+        with ApodCache(':memory:', ttl=0, today=datetime.date(2024, 1, 5)) as cache:
+            get_cached_result('2024-01-01', '2024-01-05', cache)
+            self.assertEqual(cache.missing(['2024-01-01', '2024-01-04', '2024-01-05']),
+                             ['2024-01-04', '2024-01-05'])
+
+
+def archive_days(directory, worker):
+    '''
+    Writes every fourth day of 2024-01-01 to 2024-02-09 into an archive,
+    one date at a time (run in a worker process)
+    '''
+    start = datetime.date(2024, 1, 1)
+    with ApodArchive(directory) as archive:
+        for day in range(worker, 40, 4):
+            date = (start + datetime.timedelta(days=day)).isoformat()
+            archive.put_many([{'date': date, 'title': 'x' * day}])
+
+
+class TestApodArchive(FakeApodTestCase):
+    '''
+    Offline archive test class
+    '''
+    def test_incremental_sync(self):
+        '''
+        A second sync only fetches the new days, and the archive reopens
+        '''
+        self.server.entries['2024-01-03'] = None
+        today = datetime.date(2024, 6, 1)
+        with tempfile.TemporaryDirectory() as tmp:
+            with ApodArchive(tmp, today=today) as archive:
+                report = archive.sync('2024-01-01', '2024-01-10')
+                self.assertEqual((report['fetched'], report['windows']), (10, 1))
+                report = archive.sync('2023-12-30', '2024-01-20')
+                self.assertEqual(report['fetched'], 12)
+                self.assertEqual(archive.last_synced(), '2024-01-20')
+            self.assertEqual(len(self.server.requests), 3)
+            windows = sorted(path.split('&', 1)[1] for path in self.server.requests[1:])
+            self.assertEqual(windows, ['start_date=2023-12-30&end_date=2023-12-31',
+                                       'start_date=2024-01-11&end_date=2024-01-20'])
+            with ApodArchive(tmp, today=today) as archive:
+                entries = archive.get_many(['2024-01-02', '2024-01-03', '2024-02-01'])
+                self.assertEqual(entries, {'2024-01-02': self.server.entry('2024-01-02'),
+                                           '2024-01-03': None})
+                self.assertEqual(archive.missing(['2024-01-20', '2024-01-21']), ['2024-01-21'])
+                archive.sync('2024-01-01', '2024-01-20')
+            self.assertEqual(len(self.server.requests), 3)
+
+    def test_concurrent_writers(self):
+        '''
+        Processes writing at once lose no dates, and read-only never fetches
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=4) as pool:
+                list(pool.map(archive_days, [tmp] * 4, range(4)))
+            with ApodArchive(tmp, read_only=True) as archive:
+                dates = art.date_range('2024-01-01', '2024-02-09')
+                self.assertEqual(archive.missing(dates), [])
+                entries = archive.get_many(dates)
+                self.assertEqual([entry['date'] for entry in entries.values()], dates)
+                with self.assertRaises(AppError):
+                    archive.missing(['2024-03-01'])
+                with self.assertRaises(AppError):
+                    render_mosaic('2024-03-01', '2024-03-05', 'moon', output=None,
+                                  cache=archive, store=archive)
+            self.assertEqual(self.server.requests, [])
+
+    def test_search(self):
+        '''
+        Search reads the stored postings, and an unindexed archive is indexed
+        '''
+        def expected(archive, query, first, last):
+            index = InvertedIndex()
+            for date, entry in archive.get_many(art.date_range(first, last)).items():
+                if entry is not None:
+                    index.add(date, entry)
+            return top_k(index.scores(query), 4)
+
+        self.server.entries['2024-01-05'] = None
+        ranges = (('2024-01-01', '2024-02-29'), ('2024-01-03', '2024-01-12'))
+        with tempfile.TemporaryDirectory() as tmp:
+            with ApodArchive(tmp) as archive:
+                archive.sync('2024-01-01', '2024-02-29')
+                wanted = {(query, first, last): expected(archive, query, first, last)
+                          for query in ('moon', 'nebula comet') for first, last in ranges}
+                archive.get_many = None  # searching must not read the entries
+                for (query, first, last), dates in wanted.items():
+                    self.assertEqual(archive.search(query, first, last, 4), dates)
+                self.assertTrue(wanted[('moon', '2024-01-01', '2024-02-29')])
+            os.remove(os.path.join(tmp, 'search.sqlite'))
+            with ApodArchive(tmp, read_only=True) as archive:
+                for (query, first, last), dates in wanted.items():
+                    self.assertEqual(archive.search(query, first, last, 4), dates)
+
+    def test_offline_render(self):
+        '''
+        With thumbnails synced, a mosaic renders without any request
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            with ApodArchive(tmp) as archive:
+                report = archive.sync('2024-01-01', '2024-01-10', thumbnails=True)
+                self.assertEqual(report['thumbnails'], 10)
+                requests = len(self.server.requests)
+                res = render_mosaic('2024-01-01', '2024-01-10', 'moon', output=None,
+                                    rng=random.Random(1), cache=archive, store=archive)
+            self.assertEqual((res.width, res.height), (200, 150))
+            self.assertEqual(len(self.server.requests), requests)
+
+    def test_offline_min_tile(self):
+        '''
+        Thumbnails stand in for hdurl images the archive does not have
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            with ApodArchive(tmp) as archive:
+                archive.sync('2024-01-01', '2024-01-10', thumbnails=True)
+                requests = len(self.server.requests)
+                res = render_mosaic('2024-01-01', '2024-01-10', 'moon', output=None,
+                                    rng=random.Random(1), cache=archive, store=archive,
+                                    min_tile=(210, 150))
+            self.assertEqual((res.width, res.height), (200, 150))
+            self.assertEqual(len(self.server.requests), requests)
+
+
+class TestFetch(FakeApodTestCase):
+    '''
+    Chunked fetching test class
+    '''
+    def test_chunk_ranges(self):
+        '''
+        Ranges split into windows
+        '''
+        windows = chunk_ranges([('2024-01-01', '2024-03-05'), ('2024-05-01', '2024-05-01')], 31)
+        self.assertEqual(windows, [('2024-01-01', '2024-01-31'), ('2024-02-01', '2024-03-02'),
+                                   ('2024-03-03', '2024-03-05'), ('2024-05-01', '2024-05-01')])
+
+    def test_iter_result(self):
+        '''
+        Long ranges are fetched in windows and streamed in date order
+        '''
+        entries = list(iter_result('2023-12-01', '2024-02-15', chunk_days=31, workers=3))
+        self.assertEqual(len(entries), 77)
+        self.assertEqual(entries[0]['date'], '2023-12-01')
+        self.assertEqual(entries[-1]['date'], '2024-02-15')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retry(self):
+        '''
+        Server errors are retried, client errors are not
+        '''
+        self.server.fail_next = 2
+        data = get_result(build_url('2024-01-01', '2024-01-02'), backoff=0)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(len(self.server.requests), 3)
+        with self.assertRaises(AppError):
+            get_result(self.server.base + '/nowhere', backoff=0)
+        self.assertEqual(len(self.server.requests), 4)
+
+
+class TestImageStore(FakeApodTestCase):
+    '''
+    Image store test class
+    '''
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def test_reuse_and_revalidate(self):
+        '''
+        Stored images are reused, then revalidated with their ETag
+        '''
+        url = self.server.base + '/image/a.jpg'
+        with ImageStore(self.directory) as store:
+            path = store.fetch(url)
+            self.assertEqual(store.fetch(url), path)
+            self.assertEqual(len(self.server.requests), 1)
+        with ImageStore(self.directory, max_age=0) as store:
+            self.assertEqual(store.fetch(url), path)
+            self.assertEqual((store.downloads, store.hits), (0, 1))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(SimpleImage(path).width, 200)
+
+    def test_same_content_stored_once(self):
+        '''
+        Two URLs with the same bytes share one blob
+        '''
+        with ImageStore(self.directory) as store:
+            first = store.fetch(self.server.base + '/image/a.jpg')
+            second = store.fetch(self.server.base + '/image/a.jpg?copy')
+            self.assertEqual(first, second)
+
+    def test_lru_eviction(self):
+        '''
+        Least recently used blobs are removed past max_bytes
+        '''
+        size = len(self.server.image('a.jpg'))
+        with ImageStore(self.directory, max_bytes=int(size * 2.5)) as store:
+            first = store.fetch(self.server.base + '/image/a.jpg')
+            store.fetch(self.server.base + '/image/b.jpg')
+            store.fetch(self.server.base + '/image/a.jpg')
+            store.fetch(self.server.base + '/image/c.jpg')
+            self.assertTrue(os.path.exists(first))
+            store.fetch(self.server.base + '/image/a.jpg')
+            store.fetch(self.server.base + '/image/d.jpg')
+            self.assertLessEqual(store.total_bytes(), size * 2.5)
+            self.assertTrue(os.path.exists(first))
+            self.assertEqual(len(os.listdir(os.path.join(self.directory, 'objects'))), 2)
+
+    def test_changed_content(self):
+        '''
+        A URL whose content changed releases its old blob once unused
+        '''
+        objects = os.path.join(self.directory, 'objects')
+        with ImageStore(self.directory, max_age=0) as store:
+            old = store.fetch(self.server.base + '/image/a.jpg')
+            store.fetch(self.server.base + '/image/a.jpg?copy')
+            self.server.image_size = (100, 75)
+            new = store.fetch(self.server.base + '/image/a.jpg')
+            self.assertNotEqual(new, old)
+            self.assertTrue(os.path.exists(old))
+            store.fetch(self.server.base + '/image/a.jpg?copy')
+            self.assertEqual(os.listdir(objects), [os.path.basename(new)])
+            store.max_bytes = 1
+            store.evict()
+            self.assertEqual(store.total_bytes(), os.path.getsize(new))
+            self.assertEqual(len(os.listdir(objects)), 1)
+
+
+class TestDownload(FakeApodTestCase):
+    '''
+    Concurrent download test class
+    '''
+    def test_skips_videos_and_failures(self):
+        '''
+        Videos are never fetched and failures fall back to the next entry
+        '''
+        base = self.server.base
+        self.server.truncated.add('cut.jpg')
+        entries = [
+            {'url': 'https://www.youtube.com/embed/x', 'media_type': 'video'},
+            {'url': base + '/missing.jpg', 'media_type': 'image'},
+            {'url': '//apod.nasa.gov/no-scheme.jpg', 'media_type': 'image'},
+            {'url': base + '/image/cut.jpg', 'media_type': 'image'},
+            {'url': base + '/image/a.jpg', 'media_type': 'image'},
+            {'url': base + '/image/b.jpg'},
+            {'url': base + '/image/c.jpg', 'media_type': 'image'},
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            files = download_images(entries, 2, tmp)
+            self.assertEqual([os.path.basename(f) for f in files], ['image4.jpg', 'image5.jpg'])
+            self.assertEqual(SimpleImage(files[0]).width, 200)
+            # nothing is left of the failed downloads
+            self.assertEqual(sorted(os.listdir(tmp)), ['image4.jpg', 'image5.jpg'])
+        self.assertNotIn('/image/c.jpg', self.server.requests)
+
+    def test_in_memory(self):
+        '''
+        Without a directory the bytes go straight to decoding
+        '''
+        base = self.server.base
+        entries = [{'url': base + '/image/a.jpg'}, {'url': base + '/image/b.jpg'}]
+        buffers = download_images(entries, 2)
+        self.assertIsInstance(buffers[0], memoryview)
+        transforms = get_transforms(*buffers)
+        self.assertEqual((transforms[0].width, transforms[0].height), (40, 30))
+
+    def test_render_mosaic(self):
+        '''
+        Whole pipeline against the fake API
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'pop.jpg')
+            with ApodCache(':memory:') as cache, ImageStore(os.path.join(tmp, 'store')) as store:
+                res = render_mosaic('2024-01-01', '2024-01-10', 'moon', output=output,
+                                    directory=tmp, rng=random.Random(1), cache=cache, store=store)
+            self.assertEqual((res.width, res.height), (200, 150))
+            self.assertTrue(os.path.exists(output))
+
+    def test_hd_upgrade(self):
+        '''
+        The url's own download tells whether the hdurl is needed
+        '''
+        entry = self.server.entry('2024-01-05')
+        small = self.server.image('2024-01-05.jpg')
+        data, = download_images([entry], 1, min_size=(200, 150))
+        self.assertEqual(bytes(data), small)
+        self.assertEqual(self.server.requests, ['/image/2024-01-05.jpg'])
+        self.assertEqual(self.server.bytes_sent, len(small))
+
+        data, = download_images([entry], 1, min_size=(201, 150))
+        self.assertEqual(SimpleImage(data).width, 800)
+        self.assertEqual(self.server.requests[1:],
+                         ['/image/2024-01-05.jpg', '/image/2024-01-05-hd.jpg'])
+        res = render_mosaic('2024-01-01', '2024-01-10', 'moon', output=None,
+                            rng=random.Random(1), min_tile=(100, 75))
+        self.assertEqual((res.width, res.height), (800, 600))
+
+        # a failing hdurl keeps the url image
+        broken = dict(entry, hdurl=self.server.base + '/missing.jpg')
+        data, = download_images([broken], 1, min_size=(201, 150))
+        self.assertEqual(bytes(data), small)
+
+    def test_hd_upgrade_store(self):
+        '''
+        A store only keeps the image it needs, probing the url's header
+        '''
+        entry = self.server.entry('2024-01-05')
+        small = self.server.image('2024-01-05.jpg')
+        with tempfile.TemporaryDirectory() as tmp, ImageStore(tmp) as store:
+            path, = download_images([entry], 1, store=store, min_size=(201, 150))
+            self.assertEqual(SimpleImage(path).width, 800)
+            self.assertIsNone(store.stored(entry['url']))
+            self.assertEqual(self.server.requests, ['/image/2024-01-05.jpg',
+                                                    '/image/2024-01-05-hd.jpg'])
+
+            del self.server.requests[:]
+            path, = download_images([entry], 1, store=store, min_size=(200, 150))
+            self.assertEqual(open(path, 'rb').read(), small)
+            self.assertEqual(self.server.requests, ['/image/2024-01-05.jpg'])
+            self.assertEqual(download_images([entry], 1, store=store, min_size=(200, 150)),
+                             [path])
+            self.assertEqual(len(self.server.requests), 1)
+
+            broken = dict(entry, hdurl=self.server.base + '/missing.jpg')
+            self.assertEqual(download_images([broken], 1, store=store, min_size=(201, 150)),
+                             [path])
+
+
+class TestMetrics(FakeApodTestCase):
+    '''
+    Instrumentation test class
+    '''
+    def test_render_metrics(self):
+        '''
+        Stages and counters of a whole run are recorded
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            with metrics.activate(metrics.Metrics()) as stats, ApodCache(':memory:') as cache:
+                render_mosaic('2024-01-01', '2024-01-10', 'moon', output=None,
+                              rng=random.Random(1), cache=cache)
+                render_mosaic('2024-01-01', '2024-01-10', 'moon', output=None,
+                              rng=random.Random(1), cache=cache)
+            report = stats.to_dict()
+            for name in ('search', 'download', 'decode', 'compose', 'transform.original'):
+                self.assertIn(name, report['totals'])
+            self.assertEqual(report['totals']['search']['calls'], 2)
+            counters = report['counters']
+            self.assertEqual(counters['api_cache_hits'], 10)
+            self.assertEqual(counters['api_cache_misses'], 10)
+            self.assertGreater(counters['image_bytes'], 0)
+            self.assertGreater(counters['pixels_processed'], 0)
+            path = os.path.join(tmp, 'trace.json')
+            stats.write_chrome_trace(path)
+            with open(path) as file:
+                events = json.load(file)['traceEvents']
+            self.assertEqual(events[-1]['ph'], 'C')
+        self.assertIs(metrics.current(), metrics.NULL_METRICS)
+
+
+class TestTransformCache(unittest.TestCase):
+    '''
+    Transform tile cache test class
+    '''
+    def test_reuses_tiles(self):
+        '''
+        Repeats skip decoding, and a new background only redoes its stages
+        '''
+        data1, data2, data3 = (noise_image(40, 30, seed).encode('png')
+                               for seed in range(3))
+        expected = get_transforms(data1, data2)
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = TransformCache(tmp)
+            first = get_transforms(data1, data2, cache=cache)
+            with metrics.activate(metrics.Metrics()) as stats:
+                again = get_transforms(data1, data2, cache=cache)
+            self.assertNotIn('decode', stats.to_dict()['totals'])
+            self.assertEqual(stats.to_dict()['counters']['transform_cache_hits'], 12)
+            for res, cached, original in zip(first, again, expected):
+                self.assertTrue(same_pixels(res, original))
+                self.assertIs(cached, res)
+
+            rendered = []
+            transforms = get_transforms(data1, data3, lazy=True, cache=cache)
+            transforms.on_render = rendered.append
+            compose(transforms, rng=random.Random(0), output=None)
+            self.assertTrue(set(rendered) <= art.BACKGROUND_STAGES)
+
+            on_disk = TransformCache(tmp)
+            tiles = get_transforms(data1, data2, cache=on_disk)
+            self.assertEqual(on_disk.stats()['disk_hits'], 12)
+            self.assertTrue(all(same_pixels(a, b) for a, b in zip(tiles, expected)))
+
+    def test_disk_eviction(self):
+        '''
+        Raw files beyond max_bytes go least recently used first
+        '''
+        tile_bytes = transform_cache.HEADER.size + 8 * 8 * 3
+        with tempfile.TemporaryDirectory() as tmp:
+            # a sweep frees a fifth, down to two tiles
+            writer = TransformCache(tmp, max_bytes=int(2.5 * tile_bytes))
+            writer.put('a', noise_image(8, 8, 0))
+            writer.put('b', noise_image(8, 8, 1))
+            os.utime(writer.path_for('a'), (1, 1))
+            os.utime(writer.path_for('b'), (2, 2))
+            reader = TransformCache(tmp, max_bytes=int(2.5 * tile_bytes))
+            self.assertTrue(same_pixels(reader.get('a'), noise_image(8, 8, 0)))
+            reader.put('c', noise_image(8, 8, 2))
+            self.assertEqual(sorted(os.listdir(tmp)), ['a.raw', 'c.raw'])
+            self.assertEqual(reader.total_bytes(), 2 * tile_bytes)
+
+            # puts under the limit never list the directory
+            sweeps = []
+            files = reader._files
+            reader._files = lambda: sweeps.append(1) or files()
+            reader.max_bytes = 10 * tile_bytes
+            for seed in range(3, 11):
+                reader.put(str(seed), noise_image(8, 8, seed))
+            self.assertEqual(len(sweeps), 0)
+            reader.put('11', noise_image(8, 8, 11))
+            self.assertEqual(len(sweeps), 1)
+            self.assertEqual(len(os.listdir(tmp)), 8)
+
+
+class TestService(FakeApodTestCase):
+    '''
+    Render service test class
+    '''
+    def test_warm_requests(self):
+        '''
+        A repeated request is served from the caches without the API
+        '''
+        server = service.make_server(service.RenderService(max_jobs=2), port=0)
+        threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05},
+                         daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = (f"http://127.0.0.1:{server.server_address[1]}"
+               "/mosaic?start=2024-01-01&end=2024-01-10&query=moon&seed=1")
+        with urllib.request.urlopen(url) as response:
+            first = response.read()
+        fetched = len(self.server.requests)
+        with urllib.request.urlopen(url) as response:
+            self.assertEqual(response.read(), first)
+        self.assertEqual(len(self.server.requests), fetched)
+        self.assertEqual(SimpleImage.from_bytes(first).width, 200)
+        stats = server.service.stats()
+        self.assertEqual(stats['renders'], 2)
+        self.assertEqual(stats['transforms'], {'size': 1, 'maxsize': 64, 'hits': 1, 'misses': 1})
+
+    def test_coalescing_and_lru(self):
+        '''
+        Calls for a key already running share its result; old keys are evicted
+        '''
+        coalescer = service.Coalescer()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'done'
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(coalescer.run('k', work)))
+                   for _ in range(2)]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        threads[1].start()
+        waiting = threading.Event()
+        for _ in range(500):
+            if coalescer.shared:
+                break
+            waiting.wait(0.01)
+        self.assertEqual(coalescer.shared, 1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual((results, len(calls)), (['done', 'done'], 1))
+
+        cache = service.LRUCache(2)
+        for key in 'abca':
+            cache.get_or_compute(key, lambda key=key: key * 2)
+        self.assertEqual(cache.get_or_compute('b', lambda: 'new'), 'new')
+        self.assertEqual(cache.stats(), {'size': 2, 'maxsize': 2, 'hits': 0, 'misses': 5})
+        cache.get_or_compute('c', lambda: 'old', ttl=0)
+        self.assertEqual(cache.get_or_compute('c', lambda: 'fresh', ttl=0), 'fresh')
+
+    def test_recent_ranges_expire(self):
+        '''
+        Ranges reaching today are refetched after the ttl, older ones are not
+        '''
+        render = service.RenderService(entries_ttl=0, today=datetime.date(2024, 1, 10))
+        for _ in range(2):
+            render.range_entries('2024-01-01', '2024-01-05')
+            render.range_entries('2024-01-05', '2024-01-10')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_shared_transforms(self):
+        '''
+        Threads indexing one LazyTransforms render each stage once
+        '''
+        rendered = []
+        lazy = LazyTransforms(TransformSource(noise_image(40, 30), noise_image(40, 30, seed=1)),
+                              on_render=rendered.append)
+        barrier = threading.Barrier(8)
+        def draw():
+            barrier.wait(5)
+            for index in range(len(lazy)):
+                lazy[index]  # pylint: disable=pointless-statement
+        threads = [threading.Thread(target=draw) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(sorted(rendered), sorted(name for name, _ in TRANSFORM_STAGES))
+
+
+class TestBatch(unittest.TestCase):
+    '''
+    Batch mode test class
+    '''
+    def test_read_manifest(self):
+        '''
+        CSV and JSONL manifests give the same jobs
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = os.path.join(tmp, 'jobs.csv')
+            jsonl_path = os.path.join(tmp, 'jobs.jsonl')
+            with open(csv_path, 'w') as file:
+                file.write('start_date,end_date,query\n2024-01-01,2024-01-05,moon\n')
+            with open(jsonl_path, 'w') as file:
+                file.write('{"start_date": "2024-01-01", "end_date": "2024-01-05", "query": "moon"}\n\n')
+            jobs = batch.read_manifest(csv_path)
+            self.assertEqual(jobs, batch.read_manifest(jsonl_path))
+            batch.assign_outputs(jobs, tmp)
+            self.assertEqual(jobs[0]['output'], os.path.join(tmp, 'mosaic0000.jpg'))
+
+    def test_failures_are_isolated(self):
+        '''
+        Bad jobs are reported without stopping the batch
+        '''
+        jobs = batch.assign_outputs([
+            {'start_date': 'not a date', 'end_date': '', 'query': 'moon'},
+            {'start_date': '2024-13-01', 'end_date': '', 'query': 'sun'},
+        ], 'out')
+        report = batch.run_batch(jobs, workers=2)
+        self.assertEqual(report['jobs'], 2)
+        self.assertEqual(report['failed'], 2)
+        self.assertEqual([res['query'] for res in report['results']], ['moon', 'sun'])
+        self.assertTrue(report['results'][0]['error'].startswith('ValueError'))
+
+
+class TestBenchmark(unittest.TestCase):
+    '''
+    Benchmark harness test class
+    '''
+    def test_run_and_compare(self):
+        '''
+        Every operation is timed and slowdowns are flagged
+        '''
+        report = benchmark.run_benchmarks([(40, 30)], repeat=1, corpus_days=30)
+        json.dumps(report)
+        for name in benchmark.IMAGE_BENCHMARKS:
+            self.assertIn(f"simpleimage.{name}@40x30", report['results'])
+        self.assertIn('art.compose@40x30', report['results'])
+        self.assertIn('art.get_result@31', report['results'])
+        self.assertEqual(benchmark.compare(report, report), [])
+        slower = {'results': {'a': {'median': 2.0}, 'b': {'median': 1.1}}}
+        baseline = {'results': {'a': {'median': 1.0}, 'b': {'median': 1.0}}}
+        self.assertEqual(benchmark.compare(slower, baseline), [('a', 1.0, 2.0)])
+
+
+class TestSimpleImage(unittest.TestCase):
+    '''
+    SimpleImage test class
+    '''
+    def test_shrink_box(self):
+        '''
+        Box shrink averages each block
+        '''
+        image = SimpleImage.blank(4, 2, 'black')
+        image.get_pixel(0, 0).red = 200
+        image.get_pixel(1, 1).red = 100
+        res = image.shrink(2, 'box')
+        self.assertEqual((res.width, res.height), (2, 1))
+        self.assertEqual(res.get_pixel(0, 0).red, 75)
+        self.assertEqual(res.get_pixel(1, 0).red, 0)
+        with self.assertRaises(ValueError):
+            image.shrink(2, 'cubic')
+
+    def test_color_transform(self):
+        '''
+        Lookup tables, matrices and fused chains
+        '''
+        image = noise_image(16, 16)
+        invert = ColorTransform.lut(lambda v: 255 - v)
+        half = ColorTransform.lut(lambda v: v // 2, lambda v: v, lambda v: 300)
+        chain = invert.then(half)
+        self.assertEqual(len(chain.passes), 1)
+        pix = image._get_pix_(3, 4)
+        self.assertEqual(chain.apply(image)._get_pix_(3, 4),
+                         ((255 - pix[0]) // 2, 255 - pix[1], 255))
+
+        warm = ColorTransform.tint(2.0, 1.0, 0.5)
+        fused = warm.then(ColorTransform.tint(0.5, 1.0, 2.0))
+        self.assertEqual(len(fused.passes), 1)
+        self.assertTrue(close_pixels(fused.apply(image), image, 1))
+        self.assertEqual(len(SEPIA.then(invert).passes), 2)
+        self.assertTrue(same_pixels(GRAYSCALE.apply(image), image.grayscale()))
+        with self.assertRaises(ValueError):
+            ColorTransform.lut([0] * 10)
+
+    def test_point_filters(self):
+        '''
+        Grayscale, sepia and filter match the per-pixel formulas
+        '''
+        image = noise_image(20, 15)
+        gray, sep = image.grayscale(), image.sepia()
+        kept = image.filter('green', 100)
+        self.assertTrue(same_pixels(image.filter('purple', 100), gray))
+        for x, y in ((0, 0), (7, 3), (19, 14), (11, 8)):
+            r, g, b = image._get_pix_(x, y)
+            avg = (r + g + b) // 3
+            self.assertEqual(gray._get_pix_(x, y), (avg,) * 3)
+            self.assertEqual(kept._get_pix_(x, y), (r, g, b) if g > 100 else (avg,) * 3)
+            expected = (min(255, int(0.393 * r + 0.769 * g + 0.189 * b)),
+                        min(255, int(0.349 * r + 0.686 * g + 0.168 * b)),
+                        min(255, int(0.272 * r + 0.534 * g + 0.131 * b)))
+            # sepia's native matrix pass is float32, allow rounding by 1
+            for got, want in zip(sep._get_pix_(x, y), expected):
+                self.assertLessEqual(abs(got - want), 1)
+
+    def test_greenscreen(self):
+        '''
+        Greenscreen swaps in the resized background below the threshold
+        '''
+        image = noise_image(20, 15)
+        background = noise_image(30, 10, seed=1)
+        res = image.greenscreen('red', 100, background)
+        self.assertEqual((background.width, background.height), (20, 15))
+        self.assertTrue(same_pixels(image.greenscreen('purple', 100, background), image))
+        for x in range(20):
+            for y in range(15):
+                pix = image._get_pix_(x, y)
+                expected = background._get_pix_(x, y) if pix[0] < 100 else pix
+                self.assertEqual(res._get_pix_(x, y), expected)
+
+    def test_rotate_transpose(self):
+        '''
+        Rotations and transpose move pixels to the right place
+        '''
+        image = noise_image(5, 3)
+        pix = image._get_pix_(1, 0)
+        rotated = image.rotate()
+        self.assertEqual((rotated.width, rotated.height), (3, 5))
+        self.assertEqual(rotated._get_pix_(0, 3), pix)
+        self.assertEqual(image.rotate(2)._get_pix_(3, 2), pix)
+        self.assertEqual(image.rotate(-1)._get_pix_(2, 1), pix)
+        self.assertEqual(image.transpose()._get_pix_(0, 1), pix)
+        self.assertTrue(same_pixels(image.rotate(4), image))
+
+    def test_flip(self):
+        '''
+        Flips mirror the pixels, other directions copy the image
+        '''
+        image = noise_image(9, 7)
+        pix = image._get_pix_(2, 5)
+        self.assertEqual(image.flip(0)._get_pix_(6, 5), pix)
+        self.assertEqual(image.flip(1)._get_pix_(2, 1), pix)
+        self.assertTrue(same_pixels(image.flip(0).flip(0), image))
+        same = image.flip(2)
+        self.assertIsNot(same, image)
+        self.assertTrue(same_pixels(same, image))
+
+    def test_bulk_access(self):
+        '''
+        Row, column and region accessors
+        '''
+        image = noise_image(6, 4)
+        row = image.get_row(2)
+        self.assertEqual(row[5], image._get_pix_(5, 2))
+        self.assertEqual(image.get_column(5)[2], row[5])
+        image.set_row(0, [(1, 2, 3)] * 6)
+        image.set_column(0, [(300, -5, 9)] * 4)
+        self.assertEqual(image._get_pix_(3, 0), (1, 2, 3))
+        self.assertEqual(image._get_pix_(0, 3), (255, 0, 9))
+        data = image.get_pixels((1, 1, 3, 3))
+        self.assertEqual(len(data), 12)
+        self.assertEqual(tuple(data[:3]), image._get_pix_(1, 1))
+        data[0:3] = b'\x07\x08\x09'
+        image.set_pixels((1, 1, 3, 3), data)
+        self.assertEqual(image._get_pix_(1, 1), (7, 8, 9))
+        self.assertEqual(len(image.get_pixels()), 6 * 4 * 3)
+        with self.assertRaises(ValueError):
+            image.set_row(1, [(0, 0, 0)])
+        with self.assertRaises(Exception):
+            image.get_row(100)
+        with self.assertRaises(Exception):
+            image.get_column(-1)
+        with self.assertRaises(Exception):
+            image.set_pixels((4, 2, 8, 4), bytes(24))
+
+    def test_buffered_pixels(self):
+        '''
+        Buffered pixels write back once per pixel, even after a break
+        '''
+        image = noise_image(5, 4)
+        expected = image.grayscale()
+        for pixel in image.buffered_pixels():
+            avg = (pixel.red + pixel.green + pixel.blue) // 3
+            pixel.red = avg
+            pixel.green = avg
+            pixel.blue = avg
+        self.assertTrue(same_pixels(image, expected))
+        for pixel in image.buffered_pixels():
+            pixel.red = 1
+            break
+        self.assertEqual(image._get_pix_(0, 0)[0], 1)
+        with self.assertRaises(AttributeError):
+            image.get_pixel(0, 0).extra = 1
+
+    def test_tiled(self):
+        '''
+        Tiled filters are byte for byte the whole-image filters
+        '''
+        image = noise_image(20, 15)
+        background = noise_image(9, 9, seed=1)
+        gray = image.grayscale()
+        cases = [('grayscale',), ('sepia',), ('filter', 'red', 100), ('filter', 'blue', 90, gray),
+                 ('blur', 2), ('blur',), ('greenscreen', 'blue', 120, background)]
+        for name, *args in cases:
+            whole = getattr(image, name)(*args)
+            tiled = image.tiled(name, *args, tile_size=7)
+            self.assertEqual(whole.pil_image.tobytes(), tiled.pil_image.tobytes(), name)
+        in_place = image.copy()
+        self.assertIs(in_place.tiled('sepia', tile_size=6, out=in_place), in_place)
+        self.assertTrue(same_pixels(in_place, image.sepia()))
+        with self.assertRaises(ValueError):
+            image.tiled('blur', tile_size=6, out=image)
+
+    def test_nested_iteration(self):
+        '''
+        Iterators are independent of each other
+        '''
+        image = SimpleImage.blank(3, 2)
+        pairs = [(p.x, q.x) for p in image for q in image]
+        self.assertEqual(len(pairs), 36)
+        for pixel in image:
+            break
+        self.assertEqual(next(iter(image)).x, 0)
+        self.assertEqual([(p.x, p.y) for p in image.pixels((1, 0, 3, 2))],
+                         [(1, 0), (2, 0), (1, 1), (2, 1)])
+        self.assertEqual(list(image.pixels((1, 1, 1, 2))), [])
+        self.assertEqual(list(image.bands(1)), [(0, 0, 3, 1), (0, 1, 3, 2)])
+
+    def test_parallel(self):
+        '''
+        Banded thread-pool filters match the whole-image filters
+        '''
+        image = noise_image(20, 15)
+        background = noise_image(9, 9, seed=1)
+        cases = [('sepia',), ('filter', 'green', 90), ('blur', 3),
+                 ('greenscreen', 'red', 120, background)]
+        for name, *args in cases:
+            whole = getattr(image, name)(*args)
+            banded = image.parallel(name, *args, workers=3, band_height=4)
+            self.assertTrue(same_pixels(whole, banded), name)
+        self.assertTrue(same_pixels(image.parallel('grayscale', workers=4), image.grayscale()))
+        in_place = image.copy()
+        self.assertIs(in_place.parallel('sepia', workers=2, out=in_place), in_place)
+        self.assertTrue(same_pixels(in_place, image.sepia()))
+        with self.assertRaises(ValueError):
+            image.parallel('shrink', 2)
+
+    def test_from_bytes(self):
+        '''
+        Images open from bytes, memoryviews and file objects
+        '''
+        buffer = io.BytesIO()
+        SimpleImage.blank(30, 20, 'blue').pil_image.save(buffer, 'PNG')
+        data = buffer.getvalue()
+        for source in (data, memoryview(data), io.BytesIO(data)):
+            image = SimpleImage(source)
+            self.assertEqual((image.width, image.height), (30, 20))
+            self.assertEqual(image._get_pix_(3, 3), (0, 0, 255))
+        self.assertEqual(SimpleImage.from_bytes(data).width, 30)
+        self.assertEqual(SimpleImage.file_shrunk(data, 2).width, 15)
+
+    def test_encode(self):
+        '''
+        Every output format round-trips, and compose writes to streams
+        '''
+        image = noise_image(20, 10)
+        self.assertEqual(image.encode('raw'), image.pil_image.tobytes())
+        self.assertTrue(same_pixels(SimpleImage(image.encode('png', compress_level=1)), image))
+        self.assertEqual(SimpleImage(image.encode('webp', quality=50)).width, 20)
+        small = image.encode('jpeg', quality=10)
+        self.assertLess(len(small), len(image.encode('jpeg', quality=95, optimize=True)))
+        self.assertEqual(image.encode('jpeg', progressive=True)[:2], b'\xff\xd8')
+        self.assertEqual(simpleimage.output_format('a/pop.WEBP'), 'webp')
+        self.assertEqual(simpleimage.output_format(io.BytesIO()), 'jpeg')
+
+        buffer = io.BytesIO()
+        with metrics.activate(metrics.Metrics()) as stats:
+            res = compose([image] * 12, rng=random.Random(0), output=buffer,
+                          encoding={'format': 'png'})
+        self.assertTrue(same_pixels(SimpleImage(buffer.getvalue()), res))
+        self.assertIn('encode', stats.to_dict()['totals'])
+        self.assertEqual(stats.to_dict()['counters']['encoded_bytes'], len(buffer.getvalue()))
+
+    def test_file_shrunk(self):
+        '''
+        Draft decoding gives the shrunk size
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'big.jpg')
+            SimpleImage.blank(803, 421, 'red').write(path)
+            for resample in ('nearest', 'box', 'lanczos'):
+                res = SimpleImage.file_shrunk(path, 5, resample)
+                self.assertEqual((res.width, res.height), (160, 84))
+                self.assertGreater(res.get_pixel(80, 40).red, 200)
+
+
+def noise_image(width, height, seed=0):
+    '''
+    Image with pseudo-random pixels
+    '''
+    image = SimpleImage.blank(width, height)
+    rng = random.Random(seed)
+    for pixel in image:
+        pixel.red = rng.randrange(256)
+        pixel.green = rng.randrange(256)
+        pixel.blue = rng.randrange(256)
+    return image
+
+def same_pixels(image1, image2):
+    '''
+    True if both images hold identical pixels
+    '''
+    return image1.pil_image.tobytes() == image2.pil_image.tobytes()
+
+def close_pixels(image1, image2, tolerance):
+    '''
+    True if no channel of the two images differs by more than tolerance
+    '''
+    data1 = image1.pil_image.tobytes()
+    data2 = image2.pil_image.tobytes()
+    return len(data1) == len(data2) and all(abs(a - b) <= tolerance for a, b in zip(data1, data2))
+
+
+@unittest.skipIf(simpleimage.np is None, "numpy not installed")
+class TestArrayBacked(unittest.TestCase):
+    '''
+    Array filters match the per-pixel filters
+    '''
+    def run_both(self, func):
+        '''
+        Runs func with and without the array engine
+        '''
+        old = simpleimage.ARRAY_BACKED
+        try:
+            simpleimage.ARRAY_BACKED = True
+            fast = func()
+            simpleimage.ARRAY_BACKED = False
+            slow = func()
+        finally:
+            simpleimage.ARRAY_BACKED = old
+        return fast, slow
+
+    def test_blur(self):
+        '''
+        Blur test, both engines and a plain window average
+        '''
+        image = noise_image(12, 9)
+        for radius in (1, 3):
+            fast, slow = self.run_both(lambda: image.blur(radius))
+            self.assertTrue(same_pixels(fast, slow))
+            for x, y in ((0, 0), (5, 4), (11, 8)):
+                window = [image.get_pixel(nx, ny)
+                          for nx in range(max(0, x - radius), min(12, x + radius + 1))
+                          for ny in range(max(0, y - radius), min(9, y + radius + 1))]
+                expected = sum(p.green for p in window) // len(window)
+                self.assertEqual(fast.get_pixel(x, y).green, expected)
+
+    def test_shrink_nearest(self):
+        '''
+        Nearest shrink test
+        '''
+        image = noise_image(23, 17)
+        fast, slow = self.run_both(lambda: image.shrink(5))
+        self.assertTrue(same_pixels(fast, slow))
+        self.assertEqual((fast.width, fast.height), (4, 3))
+        self.assertEqual(fast.get_pixel(1, 2).red, image.get_pixel(5, 10).red)
+
+    def test_pixel_api(self):
+        '''
+        Pixel access still works on array results
+        '''
+        gray = noise_image(4, 4).grayscale()
+        pixel = gray.get_pixel(1, 2)
+        pixel.red = 300
+        self.assertEqual(gray.get_pixel(1, 2).red, 255)
+
+
 def main():
     '''
     Main
@@ -0,0 +1,140 @@
+'''
+Inverted index and BM25 ranking for APOD entries.
+
+Entries are indexed by the words of their title and explanation, so a
+query only looks at the entries that contain its words. InvertedIndex
+lives in memory; SqliteIndex keeps the same postings in an SQLite
+database (ApodCache's) and is updated as entries are cached.
+'''
+import heapq
+import math
+import re
+from collections import Counter
+
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# BM25 parameters: k1 limits how much repeating a word helps,
+# b how much long explanations are penalised
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text: str) -> list:
+    '''
+    Lower-case words of text, without punctuation
+    '''
+    return TOKEN_RE.findall(text.lower())
+
+
+def entry_tokens(entry: dict) -> list:
+    '''
+    Words an entry is indexed by
+    '''
+    return tokenize(entry.get('title', '') or '') + tokenize(entry.get('explanation', '') or '')
+
+
+def bm25(tf: int, df: int, n_docs: int, length: int, avg_length: float) -> float:
+    '''
+    BM25 score of one query word in one document
+    '''
+    idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+    norm = K1 * (1 - B + B * length / avg_length) if avg_length else K1
+    return idf * tf * (K1 + 1) / (tf + norm)
+
+
+def top_k(scores: dict, k: int, order=None) -> list:
+    '''
+    The k keys with the highest scores, best first. Ties go to the key
+    that comes first in order (a key -> position dict), else the smaller key.
+    '''
+    if order is None:
+        return heapq.nsmallest(k, scores, key=lambda key: (-scores[key], key))
+    return heapq.nsmallest(k, scores, key=lambda key: (-scores[key], order[key]))
+
+
+class InvertedIndex:
+    '''
+    In-memory word -> {key: count} index
+    '''
+    def __init__(self):
+        self.postings = {}
+        self.lengths = {}
+        self.total_length = 0
+
+    def add(self, key, entry: dict):
+        '''
+        Indexes entry under key
+        '''
+        tokens = entry_tokens(entry)
+        for token, count in Counter(tokens).items():
+            self.postings.setdefault(token, {})[key] = count
+        self.lengths[key] = len(tokens)
+        self.total_length += len(tokens)
+
+    def scores(self, query: str) -> dict:
+        '''
+        BM25 score of every key that matches a query word
+        '''
+        n_docs = len(self.lengths)
+        avg_length = self.total_length / n_docs if n_docs else 0
+        scores = {}
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token, {})
+            for key, tf in posting.items():
+                scores[key] = scores.get(key, 0) + bm25(
+                    tf, len(posting), n_docs, self.lengths[key], avg_length)
+        return scores
+
+
+class SqliteIndex:
+    '''
+    The same index stored in SQLite tables, keyed by date
+    '''
+    def __init__(self, db):
+        self._db = db
+        self._db.execute('CREATE TABLE IF NOT EXISTS postings '
+                         '(token TEXT, date TEXT, tf INTEGER, PRIMARY KEY (token, date)) '
+                         'WITHOUT ROWID')
+        self._db.execute('CREATE INDEX IF NOT EXISTS postings_date ON postings (date)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS doc_lengths '
+                         '(date TEXT PRIMARY KEY, length INTEGER)')
+        self._db.commit()
+
+    def add(self, date: str, entry: dict):
+        '''
+        Indexes entry under date, replacing what was there. Runs in the
+        caller's transaction.
+        '''
+        self.remove(date)
+        tokens = entry_tokens(entry)
+        self._db.executemany('INSERT INTO postings VALUES (?, ?, ?)',
+                             [(token, date, tf) for token, tf in Counter(tokens).items()])
+        self._db.execute('INSERT INTO doc_lengths VALUES (?, ?)', (date, len(tokens)))
+
+    def remove(self, date: str):
+        '''
+        Drops date from the index, if it is there
+        '''
+        self._db.execute('DELETE FROM postings WHERE date = ?', (date,))
+        self._db.execute('DELETE FROM doc_lengths WHERE date = ?', (date,))
+
+    def scores(self, query: str, first: str = '0000-00-00', last: str = '9999-99-99') -> dict:
+        '''
+        BM25 score of every date from first to last that matches a query
+        word. Document counts and lengths are those of the range's
+        dates only, so the scores match an InvertedIndex of the range.
+        '''
+        n_docs, total = self._db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(length), 0) FROM doc_lengths '
+            'WHERE date BETWEEN ? AND ?', (first, last)).fetchone()
+        avg_length = total / n_docs if n_docs else 0
+        scores = {}
+        for token in set(tokenize(query)):
+            rows = self._db.execute(
+                'SELECT p.date, p.tf, d.length FROM postings p '
+                'JOIN doc_lengths d ON d.date = p.date '
+                'WHERE p.token = ? AND p.date BETWEEN ? AND ?', (token, first, last)).fetchall()
+            for date, tf, length in rows:
+                scores[date] = scores.get(date, 0) + bm25(tf, len(rows), n_docs, length, avg_length)
+        return scores
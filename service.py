@@ -0,0 +1,296 @@
+'''
+Long-running mosaic render service.
+
+    python service.py --port 8000
+    curl 'http://127.0.0.1:8000/mosaic?start=2024-01-01&end=2024-01-31&query=moon' > pop.jpg
+
+format (jpeg, png, webp or raw) and quality parameters choose the encoding.
+
+The process stays warm between requests. APOD data per date range,
+decoded and shrunk source images, and transform results are kept in
+bounded LRU caches. Ranges that reach within RECENT_DAYS of today can
+still change, so like ApodCache dates they expire after entries_ttl
+seconds. Identical requests that arrive while one is being
+rendered share its result, and at most max_jobs renders run at once.
+Nothing is ever shown on screen. GET /stats reports the caches.
+'''
+import argparse
+import collections
+import concurrent.futures
+import io
+import json
+import datetime
+import random
+import threading
+import time
+import urllib.parse
+import http.server
+import art
+from apod_cache import RECENT_DAYS
+from simpleimage import SimpleImage
+
+
+# Content-Type of each output format
+CONTENT_TYPES = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'raw': 'application/octet-stream',
+}
+
+
+class LRUCache:
+    '''
+    Thread-safe mapping that keeps the maxsize most recently used items.
+    An item may also expire at a given time.
+    '''
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = Coalescer()
+
+    def get_or_compute(self, key, compute, ttl: float = None):
+        '''
+        Cached value for key, else compute() stored under key, for ttl
+        seconds if given. Callers asking for the same missing key at
+        once share one compute().
+        '''
+        with self._lock:
+            if key in self._items:
+                value, expires = self._items[key]
+                if expires is None or time.monotonic() < expires:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+            self.misses += 1
+        value = self._inflight.run(key, compute)
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._items[key] = (value, expires)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+    def stats(self) -> dict:
+        '''
+        Size and hit counts
+        '''
+        with self._lock:
+            return {'size': len(self._items), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class Coalescer:
+    '''
+    Runs one call per key at a time; callers arriving while it runs
+    wait for and share its result (or exception)
+    '''
+    def __init__(self):
+        self.shared = 0
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, func):
+        '''
+        func() for key, or the result of the call already running for key
+        '''
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._futures[key] = future
+            else:
+                self.shared += 1
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(func())
+        except BaseException as e:  # pylint: disable=broad-except
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._futures[key]
+        return future.result()
+
+
+class RenderService:
+    '''
+    The art pipeline with warm caches between renders
+    '''
+    def __init__(self, max_jobs: int = 4, max_ranges: int = 64, max_sources: int = 128,
+                 max_transforms: int = 64, quality: int = 90, entries_ttl: float = 3600,
+                 today: datetime.date = None):
+        self.entries = LRUCache(max_ranges)
+        self.sources = LRUCache(max_sources)
+        self.transforms = LRUCache(max_transforms)
+        self.quality = quality
+        self.entries_ttl = entries_ttl
+        self.renders = 0
+        self._today = today
+        self._jobs = threading.BoundedSemaphore(max_jobs)
+        self._requests = Coalescer()
+        self._lock = threading.Lock()
+
+    @property
+    def today(self) -> datetime.date:
+        '''
+        Today's date, fixed if one was given
+        '''
+        return self._today or datetime.date.today()
+
+    def range_entries(self, start_date: str, end_date: str) -> list:
+        '''
+        APOD entries of a date range, from the cache unless the range
+        is recent and its entries are older than entries_ttl
+        '''
+        recent = (self.today - datetime.timedelta(days=RECENT_DAYS)).isoformat()
+        ttl = self.entries_ttl if end_date >= recent else None
+        return self.entries.get_or_compute(
+            (start_date, end_date), lambda: list(art.iter_result(start_date, end_date)), ttl)
+
+    def render(self, start_date: str, end_date: str, query: str, seed=None,
+               format: str = 'jpeg', quality: int = None) -> bytes:  # pylint: disable=redefined-builtin
+        '''
+        Encoded bytes of the mosaic for a request, JPEG at the service's
+        quality unless asked otherwise
+        '''
+        if quality is None and format == 'jpeg':
+            quality = self.quality
+        key = (start_date, end_date, query, seed, format, quality)
+        return self._requests.run(key, lambda: self._render(
+            start_date, end_date, query, seed, {'format': format, 'quality': quality}))
+
+    def _render(self, start_date, end_date, query, seed, encoding) -> bytes:
+        with self._jobs:
+            start_date, end_date = art.resolve_dates(start_date, end_date)
+            entries = self.range_entries(start_date, end_date)
+            ranked = art.rank_entries(entries, query, 2 + art.DOWNLOAD_SPARES)
+            picked = []
+            for entry in filter(art.is_image_entry, ranked):
+                try:
+                    picked.append((entry['url'], self._source(entry)))
+                except art.AppError as e:
+                    print(f"Skipping: {e}")
+                    continue
+                if len(picked) == 2:
+                    break
+            if len(picked) < 2:
+                raise art.AppError("Not enough images.")
+            (url1, image1), (url2, image2) = picked
+            # the background is resized in place, so give it a copy
+            transforms = self.transforms.get_or_compute(
+                (url1, url2),
+                lambda: art.LazyTransforms(art.TransformSource(image1, image2.copy())))
+            rng = random.Random(seed) if seed is not None else None
+            buffer = io.BytesIO()
+            art.compose(transforms, rng=rng, output=buffer, encoding=encoding)
+            with self._lock:
+                self.renders += 1
+            return buffer.getvalue()
+
+    def _source(self, entry: dict) -> SimpleImage:
+        '''
+        Decoded, shrunk image for an entry
+        '''
+        def load():
+            data, = art.download_images([entry], 1)
+            return SimpleImage.file_shrunk(data, art.SHRINK_SCALE)
+        return self.sources.get_or_compute(entry['url'], load)
+
+    def stats(self) -> dict:
+        '''
+        Cache and render counts
+        '''
+        with self._lock:
+            renders = self.renders
+        return {
+            'renders': renders,
+            'coalesced': self._requests.shared,
+            'entries': self.entries.stats(),
+            'sources': self.sources.stats(),
+            'transforms': self.transforms.stats(),
+        }
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    '''
+    GET /mosaic?start=&end=&query=&seed=&format=&quality= and GET /stats
+    '''
+    def do_GET(self):  # pylint: disable=invalid-name
+        service = self.server.service
+        parsed = urllib.parse.urlparse(self.path)
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(parsed.query).items()}
+        if parsed.path == '/stats':
+            self._send(200, 'application/json', json.dumps(service.stats()).encode())
+            return
+        if parsed.path != '/mosaic':
+            self._send(404, 'text/plain', b'not found')
+            return
+        format = params.get('format', 'jpeg').lower()  # pylint: disable=redefined-builtin
+        if format not in CONTENT_TYPES:
+            self._send(400, 'text/plain', f"unknown format {format}".encode())
+            return
+        try:
+            seed = int(params['seed']) if 'seed' in params else None
+            quality = int(params['quality']) if 'quality' in params else None
+            body = service.render(params.get('start', ''), params.get('end', ''),
+                                  params.get('query', ''), seed, format, quality)
+        except ValueError as e:
+            self._send(400, 'text/plain', str(e).encode())
+        except art.AppError as e:
+            self._send(502, 'text/plain', str(e).encode())
+        else:
+            self._send(200, CONTENT_TYPES[format], body)
+
+    def _send(self, code: int, content_type: str, body: bytes):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(service: RenderService, host: str = '127.0.0.1', port: int = 8000,
+                verbose: bool = False) -> http.server.ThreadingHTTPServer:
+    '''
+    HTTP server for service; call serve_forever() on it
+    '''
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def main(argv: list = None):
+    '''
+    Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description="Serve APOD mosaics over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-jobs', type=int, default=4, help="renders running at once")
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    args = parser.parse_args(argv)
+    server = make_server(RenderService(max_jobs=args.max_jobs), args.host, args.port, args.verbose)
+    print(f"Serving on http://{args.host}:{server.server_address[1]}/mosaic")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
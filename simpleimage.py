@@ -1,6 +1,24 @@
+import concurrent.futures
+import io
+import os
 import sys
 from PIL import Image
 
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, blur and shrink fall back to the Pixel loops
+    np = None
+
+
+# When True (and numpy is installed) blur and nearest shrink run as
+# whole-image array operations instead of visiting every Pixel. The other
+# built-in filters always use Pillow's native passes.
+ARRAY_BACKED = np is not None
+
+# Side of the squares tiled() filters at a time. The filters' working
+# buffers are bounded by this rather than by the image size.
+TILE_SIZE = 512
+
 
 def clamp(num):
     """
@@ -21,6 +39,8 @@ class Pixel(object):
     Supports set/get .red .green .blue
     and get .x .y
     """
+    __slots__ = ('image', '_x', '_y')
+
     def __init__(self, image, x, y):
         self.image = image
         self._x = x
@@ -68,6 +88,81 @@ class Pixel(object):
         return self._y
 
 
+class PixelIterator(object):
+    """
+    Walks the Pixels of a box of an image, row by row. It keeps its own
+    position, so several can run over one image at once.
+    """
+    __slots__ = ('image', '_x', '_y', '_left', '_right', '_bottom')
+
+    def __init__(self, image, box=None):
+        if box is None:
+            box = (0, 0, image.width, image.height)
+        self.image = image
+        self._left, self._y, self._right, self._bottom = box
+        self._x = self._left
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._x >= self._right:
+            self._x = self._left
+            self._y += 1
+        if self._y >= self._bottom or self._left >= self._right:
+            raise StopIteration()
+        pixel = Pixel(self.image, self._x, self._y)
+        self._x += 1
+        return pixel
+
+
+class BufferedPixel(Pixel):
+    """
+    A Pixel that reads its color once and keeps channel edits to itself
+    until commit() writes them back as one tuple. Made by
+    SimpleImage.buffered_pixels(), which commits each pixel for you.
+    """
+    __slots__ = ('_rgb', '_dirty')
+
+    def __init__(self, image, x, y):
+        super().__init__(image, x, y)
+        self._rgb = list(image.px[x, y])
+        self._dirty = False
+
+    @property
+    def red(self):
+        return self._rgb[0]
+
+    @red.setter
+    def red(self, value):
+        self._rgb[0] = clamp(value)
+        self._dirty = True
+
+    @property
+    def green(self):
+        return self._rgb[1]
+
+    @green.setter
+    def green(self, value):
+        self._rgb[1] = clamp(value)
+        self._dirty = True
+
+    @property
+    def blue(self):
+        return self._rgb[2]
+
+    @blue.setter
+    def blue(self, value):
+        self._rgb[2] = clamp(value)
+        self._dirty = True
+
+    def commit(self):
+        """Write any channel edits into the image."""
+        if self._dirty:
+            self.image.px[self._x, self._y] = tuple(self._rgb)
+            self._dirty = False
+
+
 # color tuples for background color names 'red' 'white' etc.
 BACK_COLORS = {
     'white': (255, 255, 255),
@@ -78,16 +173,247 @@ BACK_COLORS = {
 }
 
 
+# Pillow filters for the shrink() resample names
+RESAMPLE_FILTERS = {
+    'nearest': Image.NEAREST,
+    'box': Image.BOX,
+    'lanczos': Image.LANCZOS,
+}
+
+# Pillow transpose methods for flip() directions and rotate() quarter turns
+FLIP_METHODS = {
+    0: Image.FLIP_LEFT_RIGHT,
+    1: Image.FLIP_TOP_BOTTOM,
+}
+ROTATE_METHODS = {
+    1: Image.ROTATE_90,
+    2: Image.ROTATE_180,
+    3: Image.ROTATE_270,
+}
+
+# filters that tiled() and parallel() can run a box at a time
+TILED_FILTERS = ('grayscale', 'sepia', 'filter', 'greenscreen', 'blur')
+
+# index of each named channel in an RGB pixel
+CHANNELS = {
+    'red': 0,
+    'green': 1,
+    'blue': 2,
+}
+
+# Pillow formats for encode() format names. 'raw' is not a Pillow
+# format: it is the bare RGB bytes, row by row.
+OUTPUT_FORMATS = {
+    'jpeg': 'JPEG',
+    'jpg': 'JPEG',
+    'png': 'PNG',
+    'webp': 'WEBP',
+    'raw': None,
+}
+
+
+def _pack(pixels, count):
+    """RGB bytes of a list of count (r, g, b) tuples."""
+    if len(pixels) != count:
+        raise ValueError('Expected {} pixels but got {}'.format(count, len(pixels)))
+    return bytes(clamp(v) for pix in pixels for v in pix[:3])
+
+
+def _unpack(data):
+    """List of (r, g, b) tuples from RGB bytes."""
+    return list(zip(data[0::3], data[1::3], data[2::3]))
+
+
+def _open(source):
+    """Image.open for a path, a file object, or bytes-like encoded data."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    return Image.open(source)
+
+
+def output_format(target):
+    """
+    encode() format name for a file name's extension, or 'jpeg' for a
+    stream or an extension Pillow does not know.
+    """
+    if isinstance(target, (str, os.PathLike)):
+        ext = os.path.splitext(target)[1].lower()
+        if ext == '.raw':
+            return 'raw'
+        pil_format = Image.registered_extensions().get(ext)
+        if pil_format is not None:
+            return pil_format.lower()
+    return 'jpeg'
+
+
+def write_bytes(target, data):
+    """Write data to a file name or a binary stream."""
+    if hasattr(target, 'write'):
+        target.write(data)
+        return
+    with open(target, 'wb') as file:
+        file.write(data)
+
+
+def _window_bounds(length, radius):
+    """Start/stop indices of the clipped window around each of length positions."""
+    starts = [max(0, i - radius) for i in range(length)]
+    stops = [min(length, i + radius + 1) for i in range(length)]
+    return starts, stops
+
+
+def _box_blur_array(arr, radius):
+    """Box blur of an array using a summed-area table."""
+    height, width = arr.shape[:2]
+    table = np.zeros((height + 1, width + 1, 3), dtype=np.int64)
+    table[1:, 1:] = arr.cumsum(axis=0, dtype=np.int64).cumsum(axis=1)
+    y0, y1 = (np.array(b)[:, None] for b in _window_bounds(height, radius))
+    x0, x1 = (np.array(b)[None, :] for b in _window_bounds(width, radius))
+    total = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+    count = (y1 - y0) * (x1 - x0)
+    return total // count[..., None]
+
+
+def _box_blur_pixels(image, radius):
+    """
+    Box blur without numpy: prefix sums along each row, then
+    prefix sums of those row sums down each column.
+    """
+    width, height = image.width, image.height
+    data = image.pil_image.tobytes()
+    out = bytearray(len(data))
+    x0, x1 = _window_bounds(width, radius)
+    y0, y1 = _window_bounds(height, radius)
+    for c in range(3):
+        plane = data[c::3]
+        row_sums = []
+        for y in range(height):
+            prefix = [0]
+            for value in plane[y * width:(y + 1) * width]:
+                prefix.append(prefix[-1] + value)
+            row_sums.append([prefix[x1[x]] - prefix[x0[x]] for x in range(width)])
+        for x in range(width):
+            prefix = [0]
+            for y in range(height):
+                prefix.append(prefix[-1] + row_sums[y][x])
+            for y in range(height):
+                count = (x1[x] - x0[x]) * (y1[y] - y0[y])
+                out[(y * width + x) * 3 + c] = (prefix[y1[y]] - prefix[y0[y]]) // count
+    return SimpleImage.from_pil(Image.frombytes('RGB', (width, height), bytes(out)))
+
+
+class ColorTransform(object):
+    """
+    A point operation (each output pixel depends only on the same input
+    pixel) compiled to passes Pillow runs natively over the whole image:
+    3x3 colour matrices (with an offset per channel) and per-channel
+    256-entry lookup tables. Like the Pixel setters, values are
+    truncated to int and clamped to 0..255.
+
+        warm = ColorTransform.tint(1.1, 1.0, 0.8)
+        faded = SEPIA.then(warm).then(ColorTransform.lut(lambda v: v // 2 + 64))
+        res = faded.apply(image)
+
+    then() fuses neighbouring passes of the same kind, so a chain of
+    matrices or a chain of tables costs a single pass. Fused matrices
+    are multiplied together, so values are not clamped between them.
+    """
+    def __init__(self, passes=()):
+        self.passes = list(passes)
+
+    @classmethod
+    def matrix(cls, rows, offsets=(0, 0, 0)):
+        """
+        Transform from a 3x3 matrix: new red = rows[0][0] * red +
+        rows[0][1] * green + rows[0][2] * blue + offsets[0], and so on.
+        """
+        flat = []
+        for row, offset in zip(rows, offsets):
+            flat.extend(row)
+            flat.append(offset)
+        return cls([('matrix', tuple(flat))])
+
+    @classmethod
+    def lut(cls, red, green=None, blue=None):
+        """
+        Transform from per-channel tables: each of red/green/blue is a
+        256-entry sequence or a function of the channel value. green and
+        blue default to red.
+        """
+        tables = []
+        for table in (red, green or red, blue or red):
+            if callable(table):
+                table = [table(v) for v in range(256)]
+            if len(table) != 256:
+                raise ValueError('Lookup table needs 256 entries, got {}'.format(len(table)))
+            tables.extend(clamp(v) for v in table)
+        return cls([('lut', tuple(tables))])
+
+    @classmethod
+    def tint(cls, red, green, blue):
+        """Transform that scales each channel by the given factor."""
+        return cls.matrix(((red, 0, 0), (0, green, 0), (0, 0, blue)))
+
+    def then(self, other):
+        """Transform that applies self and then other."""
+        passes = list(self.passes)
+        for kind, data in other.passes:
+            if passes and passes[-1][0] == kind:
+                passes[-1] = (kind, _fuse(kind, passes[-1][1], data))
+            else:
+                passes.append((kind, data))
+        return ColorTransform(passes)
+
+    def apply(self, image):
+        """New image with the transform applied to image."""
+        pil_image = image.pil_image
+        for kind, data in self.passes:
+            if kind == 'matrix':
+                # Pillow rounds to nearest; shift down to truncate like int()
+                shifted = tuple(v - 0.4999 if i % 4 == 3 else v for i, v in enumerate(data))
+                pil_image = pil_image.convert('RGB', shifted)
+            else:
+                pil_image = pil_image.point(list(data))
+        if pil_image is image.pil_image:
+            pil_image = pil_image.copy()
+        return SimpleImage.from_pil(pil_image)
+
+
+def _fuse(kind, first, second):
+    """Data of a single pass doing the first pass then the second."""
+    if kind == 'lut':
+        return tuple(second[c * 256 + first[c * 256 + v]] for c in range(3) for v in range(256))
+    fused = []
+    for row in range(3):
+        a = second[row * 4:row * 4 + 4]
+        for col in range(4):
+            value = sum(a[k] * first[k * 4 + col] for k in range(3))
+            if col == 3:
+                value += a[3]
+            fused.append(value)
+    return tuple(fused)
+
+
+GRAYSCALE = ColorTransform.matrix(((1 / 3, 1 / 3, 1 / 3),) * 3)
+
+SEPIA = ColorTransform.matrix((
+    (0.393, 0.769, 0.189),
+    (0.349, 0.686, 0.168),
+    (0.272, 0.534, 0.131),
+))
+
+
 class SimpleImage(object):
     def __init__(self, filename, width=0, height=0, back_color=None):
         """
         Create a new image. This case works: SimpleImage('foo.jpg')
+        filename may also be bytes, a memoryview or a binary file object.
         To create a blank image use SimpleImage.blank(500, 300)
         The other parameters here are for internal/experimental use.
         """
         # Create pil_image either from file, or making blank
         if filename:
-            self.pil_image = Image.open(filename).convert("RGB")
+            self.pil_image = _open(filename).convert("RGB")
             if self.pil_image.mode != 'RGB':
                 raise Exception('Image file is not RGB')
             self._filename = filename  # hold onto
@@ -99,17 +425,24 @@ class SimpleImage(object):
                 raise Exception('Creating blank image requires width/height but got {} {}'
                                 .format(width, height))
             self.pil_image = Image.new('RGB', (width, height), color_tuple)
-        self.px = self.pil_image.load()
-        size = self.pil_image.size
-        self._width = size[0]
-        self._height = size[1]
+        self._adopt(self.pil_image)
         self.curr_x = 0
         self.curr_y = 0
 
+    def _adopt(self, pil_image):
+        """Point this image at the given Pillow image, refreshing px and size."""
+        self.pil_image = pil_image
+        self.px = pil_image.load()
+        size = pil_image.size
+        self._width = size[0]
+        self._height = size[1]
+
     def __iter__(self):
-        return self
+        # a fresh iterator each time, so loops can nest or run in threads
+        return PixelIterator(self)
 
     def __next__(self):
+        # kept for code that calls next(image) directly
         if self.curr_x < self.width and self.curr_y < self.height:
             x = self.curr_x
             y = self.curr_y
@@ -136,6 +469,51 @@ class SimpleImage(object):
         """Create a new image based on a file, alternative to raw constructor."""
         return SimpleImage(filename)
 
+    @classmethod
+    def from_bytes(cls, data):
+        """Create a new image from encoded image bytes, e.g. a downloaded JPEG."""
+        return SimpleImage(data)
+
+    @classmethod
+    def file_shrunk(cls, filename, scale, resample='box'):
+        """
+        Open a file (or bytes, memoryview, file object) already shrunk by
+        scale, like shrink(SimpleImage(filename), scale).
+        JPEGs are decoded at reduced size (Pillow draft mode), so the
+        full-resolution pixels are never built.
+        """
+        pil_image = _open(filename)
+        new_size = (pil_image.width // scale, pil_image.height // scale)
+        pil_image.draft('RGB', new_size)
+        image = cls.from_pil(pil_image)
+        if image.width == new_size[0] * scale and image.height == new_size[1] * scale:
+            return image.shrink(scale, resample)
+        return cls.from_pil(image.pil_image.resize(new_size, RESAMPLE_FILTERS[resample]))
+
+    @classmethod
+    def from_pil(cls, pil_image):
+        """Wrap an existing Pillow image (converted to RGB) without copying pixels."""
+        if pil_image.mode != 'RGB':
+            pil_image = pil_image.convert('RGB')
+        image = cls.__new__(cls)
+        image._adopt(pil_image)
+        image.curr_x = 0
+        image.curr_y = 0
+        return image
+
+    @classmethod
+    def from_array(cls, array):
+        """Create a new image from a height x width x 3 uint8 numpy array."""
+        array = np.ascontiguousarray(array, dtype=np.uint8)
+        return cls.from_pil(Image.fromarray(array))
+
+    def to_array(self):
+        """
+        Returns the pixels as a read-only height x width x 3 uint8 numpy array.
+        Use from_array() to turn a modified array back into an image.
+        """
+        return np.asarray(self.pil_image)
+
     @property
     def width(self):
         """Width of image in pixels."""
@@ -180,61 +558,223 @@ class SimpleImage(object):
         """Set the given pix RGB tuple into the image at the given x,y."""
         self.px[x, y] = pix
 
+    def buffered_pixels(self):
+        """
+        Like `for pixel in image`, but each pixel is a BufferedPixel:
+        its color is read once and edits to .red .green .blue are written
+        back together when the loop moves on (or stops).
+        """
+        pixel = None
+        try:
+            for y in range(self.height):
+                for x in range(self.width):
+                    pixel = BufferedPixel(self, x, y)
+                    yield pixel
+                    pixel.commit()
+        finally:
+            if pixel is not None:
+                pixel.commit()
+
+    def _check_box(self, name, box):
+        """Raises like get_pixel unless the box lies within the image."""
+        left, top, right, bottom = box
+        if left < 0 or top < 0 or right > self._width or bottom > self.height \
+                or left >= right or top >= bottom:
+            e = Exception('%s bad box (%d, %d, %d, %d) (vs. image width %d height %d)' %
+                          (name, left, top, right, bottom, self._width, self.height))
+            raise e
+
+    def get_pixels(self, box=None):
+        """
+        Returns the RGB bytes of the (left, top, right, bottom) box, the
+        whole image by default, row by row, 3 bytes per pixel.
+        """
+        if box is None:
+            return bytearray(self.pil_image.tobytes())
+        self._check_box('get_pixels', box)
+        return bytearray(self.pil_image.crop(box).tobytes())
+
+    def set_pixels(self, box, data):
+        """Writes RGB bytes as returned by get_pixels() into the box."""
+        self._check_box('set_pixels', box)
+        size = (box[2] - box[0], box[3] - box[1])
+        self.pil_image.paste(Image.frombytes('RGB', size, bytes(data)), box[:2])
+
+    def get_row(self, y):
+        """List of the (r, g, b) tuples in row y."""
+        return _unpack(self.get_pixels((0, y, self.width, y + 1)))
+
+    def set_row(self, y, pixels):
+        """Set row y from a list of (r, g, b) tuples."""
+        self.set_pixels((0, y, self.width, y + 1), _pack(pixels, self.width))
+
+    def get_column(self, x):
+        """List of the (r, g, b) tuples in column x."""
+        return _unpack(self.get_pixels((x, 0, x + 1, self.height)))
+
+    def set_column(self, x, pixels):
+        """Set column x from a list of (r, g, b) tuples."""
+        self.set_pixels((x, 0, x + 1, self.height), _pack(pixels, self.height))
+
     def show(self):
         """Displays the image using an external utility."""
         self.pil_image.show()
 
     def make_as_big_as(self, image):
         """Resizes image to the shape of the given image"""
-        self.pil_image = self.pil_image.resize((image.width, image.height))
-        self.px = self.pil_image.load()
-        size = self.pil_image.size
-        self._width = size[0]
-        self._height = size[1]
+        if (self.width, self.height) == (image.width, image.height):
+            return
+        self._adopt(self.pil_image.resize((image.width, image.height)))
+
+    def write(self, path, format=None, **options):
+        """
+        Write image to a file name or a binary stream, encoded by
+        encode(format, **options). format defaults to the file name's
+        extension, or JPEG for a stream.
+        """
+        if format is None:
+            format = output_format(path)
+        write_bytes(path, self.encode(format, **options))
 
-    def write(self, path):
-        """Write image to file"""
-        self.pil_image.save(path)
+    def encode(self, format='jpeg', quality=None, optimize=False, progressive=False,
+               compress_level=None):
+        """
+        The image encoded as bytes. format is 'jpeg', 'png', 'webp', 'raw'
+        (uncompressed RGB rows) or another Pillow format name. quality
+        (JPEG, WebP), optimize, progressive (JPEG) and compress_level
+        (PNG, 0 fastest to 9 smallest) trade speed against size; options
+        left unset keep Pillow's defaults.
+        """
+        format = format.lower()
+        if format == 'raw':
+            return self.pil_image.tobytes()
+        options = {}
+        if quality is not None:
+            options['quality'] = quality
+        if optimize:
+            options['optimize'] = True
+        if progressive:
+            options['progressive'] = True
+        if compress_level is not None:
+            options['compress_level'] = compress_level
+        buffer = io.BytesIO()
+        self.pil_image.save(buffer, OUTPUT_FORMATS.get(format, format.upper()), **options)
+        return buffer.getvalue()
 
     def copy(self):
         """Returns a deep copy of the SimpleImage object."""
-        new_image = SimpleImage.blank(self.width, self.height)
-        new_image.pil_image = self.pil_image.copy()
-        new_image.px = new_image.pil_image.load()
-        return new_image
-
-    def grayscale(image):
-        gray = image.copy()
-
-        for pixel in gray:
-            avg = (pixel.red + pixel.green + pixel.blue) // 3
-            pixel.red = avg
-            pixel.green = avg
-            pixel.blue = avg
-        return gray
+        return SimpleImage.from_pil(self.pil_image.copy())
 
-    def sepia(image):
-        sep = image.copy()
-
-        for pixel in sep:
-            og_red = pixel.red
-            og_green = pixel.green
-            og_blue = pixel.blue
+    def tiled(self, name, *args, tile_size=TILE_SIZE, out=None):
+        """
+        Run the built-in filter called name ('grayscale', 'sepia',
+        'filter', 'greenscreen' or 'blur') with args, one tile_size
+        square at a time, pasting each result into out (a new image by
+        default) before the next tile is filtered. The result is the
+        same as calling the filter on the whole image, but the filter's
+        temporary buffers, such as blur's summed-area table, only ever
+        hold one tile. Blur tiles are read with a border of radius extra
+        pixels. For point filters out may be the image itself, to avoid
+        a second full-size buffer.
+        """
+        boxes = [(x, y, min(self.width, x + tile_size), min(self.height, y + tile_size))
+                 for y in range(0, self.height, tile_size)
+                 for x in range(0, self.width, tile_size)]
+        return self._run_boxes(name, args, boxes, out, None)
 
-            new_red = int(0.393 * og_red + 0.769 * og_green + 0.189 * og_blue)
-            new_green = int(0.349 * og_red + 0.686 * og_green + 0.168 * og_blue)
-            new_blue = int(0.272 * og_red + 0.534 * og_green + 0.131 * og_blue)
+    def parallel(self, name, *args, workers=None, band_height=None, out=None):
+        """
+        Like tiled(), but the image is cut into horizontal bands that
+        a pool of workers threads filter at the same time. Pillow and
+        numpy release the GIL during their whole-image work, so bands
+        really do run in parallel. band_height defaults to an even split
+        across the workers.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if band_height is None:
+            band_height = max(1, -(-self.height // workers))
+        boxes = list(self.bands(band_height))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            return self._run_boxes(name, args, boxes, out, pool)
+
+    def _run_boxes(self, name, args, boxes, out, pool):
+        """
+        Filter each box of the image separately (on pool if given) and
+        paste the results into out.
+        """
+        if name not in TILED_FILTERS:
+            raise ValueError('Filter {} cannot be tiled'.format(name))
+        halo = 0
+        if name == 'blur':
+            halo = args[0] if args else 1
+            if out is self:
+                raise ValueError('blur cannot be tiled in place')
+        if name == 'greenscreen':
+            args[2].make_as_big_as(self)
+        if out is None:
+            out = SimpleImage.blank(self.width, self.height)
+
+        def run(box):
+            outer = (max(0, box[0] - halo), max(0, box[1] - halo),
+                     min(self.width, box[2] + halo), min(self.height, box[3] + halo))
+            tile = SimpleImage.from_pil(self.pil_image.crop(outer))
+            # images passed along (greenscreen's background, filter's
+            # gray) are cut to the same box
+            tile_args = [SimpleImage.from_pil(arg.pil_image.crop(outer))
+                         if isinstance(arg, SimpleImage) else arg for arg in args]
+            res = getattr(SimpleImage, name)(tile, *tile_args)
+            inner = (box[0] - outer[0], box[1] - outer[1],
+                     box[2] - outer[0], box[3] - outer[1])
+            return res.pil_image.crop(inner)
+
+        # map() is lazy, so without a pool each tile is pasted before
+        # the next one is filtered
+        results = pool.map(run, boxes) if pool is not None else map(run, boxes)
+        # pasting stays on this thread, one box at a time
+        for box, res in zip(boxes, results):
+            out.pil_image.paste(res, box[:2])
+        return out
+
+    def bands(self, band_height):
+        """(left, top, right, bottom) boxes of horizontal bands covering the image."""
+        for top in range(0, self.height, band_height):
+            yield (0, top, self.width, min(self.height, top + band_height))
+
+    def pixels(self, box=None):
+        """
+        Iterator over the Pixels of the (left, top, right, bottom) box,
+        the whole image by default, row by row. Each call gives a new,
+        independent iterator.
+        """
+        return PixelIterator(self, box)
 
-            pixel.red = min(255, new_red)
-            pixel.green = min(255, new_green)
-            pixel.blue = min(255, new_blue)
+    def grayscale(image):
+        return GRAYSCALE.apply(image)
 
-        return sep
+    def sepia(image):
+        return SEPIA.apply(image)
 
-    def shrink(image, scale):
+    def shrink(image, scale, resample='nearest'):
+        """
+        Shrink the image by an integer scale factor. resample picks
+        how each output pixel is made: 'nearest' takes the top-left pixel
+        of its scale x scale block, 'box' averages the block and
+        'lanczos' uses Pillow's Lanczos filter.
+        """
+        if resample not in RESAMPLE_FILTERS:
+            raise ValueError('Unknown resample filter {}'.format(resample))
         new_width = image.width // scale
         new_height = image.height // scale
 
+        if resample != 'nearest':
+            box = (0, 0, new_width * scale, new_height * scale)
+            return SimpleImage.from_pil(image.pil_image.resize(
+                (new_width, new_height), RESAMPLE_FILTERS[resample], box=box))
+        if ARRAY_BACKED:
+            arr = image.to_array()
+            return SimpleImage.from_array(arr[:new_height * scale:scale, :new_width * scale:scale])
+
         res = SimpleImage.blank(new_width, new_height)
 
         for y in range(new_height):
@@ -252,75 +792,64 @@ class SimpleImage(object):
         return res
 
     def flip(image, direction):
-        flipped = image.copy()
-        if direction == 0:
-            for x in range(image.width):
-                for y in range(image.height):
-                    flipped.set_pixel(x, y, image.get_pixel(image.width - 1 - x, y))
-        elif direction == 1: 
-            for x in range(image.width):
-                for y in range(image.height):
-                    flipped.set_pixel(x, y, image.get_pixel(x, image.height - 1 - y))
-        return flipped
-
-    def blur(image):
-        res = image.copy()
-        for y in range(1, image.height - 1):
-            for x in range(1, image.width - 1):
-                total_red = 0
-                total_green = 0
-                total_blue = 0
-                count = 0
-
-                for ny in range(y - 1, y + 2):
-                    for nx in range(x - 1, x + 2):
-                        if 0 <= nx < image.width and 0 <= ny < image.height:
-                            neighbor = image.get_pixel(nx, ny)
-                            total_red += neighbor.red
-                            total_green += neighbor.green
-                            total_blue += neighbor.blue
-                            count += 1
-                avg_red = total_red // count
-                avg_green = total_green // count
-                avg_blue = total_blue // count
-                pixel = res.get_pixel(x, y)
-                pixel.red = avg_red
-                pixel.green = avg_green
-                pixel.blue = avg_blue
-        return res
+        """Mirror the image: direction 0 flips left-right, 1 flips top-bottom."""
+        if direction not in FLIP_METHODS:
+            return image.copy()
+        return image._transposed(FLIP_METHODS[direction])
+
+    def rotate(image, quarter_turns=1):
+        """Rotate the image counter-clockwise by quarter_turns * 90 degrees."""
+        quarter_turns %= 4
+        if quarter_turns == 0:
+            return image.copy()
+        return image._transposed(ROTATE_METHODS[quarter_turns])
+
+    def transpose(image):
+        """Swap x and y, mirroring the image along its main diagonal."""
+        return image._transposed(Image.TRANSPOSE)
+
+    def _transposed(self, method):
+        return SimpleImage.from_pil(self.pil_image.transpose(method))
+
+    def blur(image, radius=1):
+        """
+        Box blur: each pixel becomes the average of the square of
+        side 2 * radius + 1 around it. Near the edges only the
+        neighbours inside the image are averaged. The work per pixel
+        is the same for any radius.
+        """
+        if radius < 1:
+            return image.copy()
+        if ARRAY_BACKED:
+            return SimpleImage.from_array(_box_blur_array(image.to_array(), radius))
+        return _box_blur_pixels(image, radius)
 
-    def filter(image, channel, intensity):
-        res = image.copy()
-        for pixel in res:
-            if (channel == 'red' and pixel.red > intensity) or (channel == 'green' and pixel.green > intensity) or (channel == 'blue' and pixel.blue > intensity):
-                pass
-            else:
-                avg = (pixel.red + pixel.green + pixel.blue) // 3
-                pixel.red = avg
-                pixel.green = avg
-                pixel.blue = avg
-        return res
+    def filter(image, channel, intensity, gray=None):
+        """
+        Keep pixels whose channel is above intensity, turn the rest gray.
+        gray may be image.grayscale() computed earlier, to reuse it.
+        """
+        if gray is None:
+            gray = GRAYSCALE.apply(image)
+        if channel not in CHANNELS:
+            return gray.copy()
+        # threshold the channel through a lookup table into a keep mask
+        mask = image.pil_image.getchannel(CHANNELS[channel]).point(
+            [255 if v > intensity else 0 for v in range(256)])
+        return SimpleImage.from_pil(Image.composite(image.pil_image, gray.pil_image, mask))
 
     def greenscreen(image1, channel, intensity, image2):
-        greenscreened = image1.copy()
-        image2.make_as_big_as(greenscreened)
-        for pixel in greenscreened:
-            if channel == 'red' and pixel.red < intensity:
-                bg_pixel = image2.get_pixel(pixel.x, pixel.y)
-                pixel.red = bg_pixel.red
-                pixel.green = bg_pixel.green
-                pixel.blue = bg_pixel.blue
-            elif channel == 'green' and pixel.green < intensity:
-                bg_pixel = image2.get_pixel(pixel.x, pixel.y)
-                pixel.red = bg_pixel.red
-                pixel.green = bg_pixel.green
-                pixel.blue = bg_pixel.blue
-            elif channel == 'blue' and pixel.blue < intensity:
-                bg_pixel = image2.get_pixel(pixel.x, pixel.y)
-                pixel.red = bg_pixel.red
-                pixel.green = bg_pixel.green
-                pixel.blue = bg_pixel.blue
-        return greenscreened
+        """
+        Replace the pixels whose channel is below intensity with the
+        pixels of image2, which is resized to match image1 first.
+        """
+        image2.make_as_big_as(image1)
+        if channel not in CHANNELS:
+            return image1.copy()
+        # threshold the channel through a lookup table into a swap mask
+        mask = image1.pil_image.getchannel(CHANNELS[channel]).point(
+            [255 if v < intensity else 0 for v in range(256)])
+        return SimpleImage.from_pil(Image.composite(image2.pil_image, image1.pil_image, mask))
 
 
 def main():
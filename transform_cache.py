@@ -0,0 +1,201 @@
+'''
+Cache of rendered transform tiles.
+
+A tile is keyed by the content hash of its source image, the shrink
+factor, the transform name and its parameters, plus the background's
+hash for transforms that use one. The same APOD picked again, by any
+query, reuses its tiles instead of transforming it again. Tiles live in
+an in-memory LRU and, if a directory is given, as raw RGB files there,
+so worker processes share them. Raw files are written to a temp file
+and renamed into place, like ImageStore blobs. Reading a file touches
+it. The cache keeps a running total of the files' size, counted once
+from the directory and then by its own writes; when that goes over
+max_bytes, the directory is swept and the least recently used files
+are removed until SWEEP_FREES of max_bytes is free again.
+'''
+import collections
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+from PIL import Image
+from simpleimage import SimpleImage
+
+
+# raw tile file: magic, width, height, then width * height RGB bytes
+HEADER = struct.Struct('<4sII')
+MAGIC = b'APT1'
+
+# share of max_bytes a sweep frees, so the next sweep is that many
+# written bytes away
+SWEEP_FREES = 0.2
+
+
+def content_hash(data) -> str:
+    '''
+    SHA-256 of an image's encoded bytes, given as bytes, a memoryview
+    or a file name
+    '''
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(data).hexdigest()
+    digest = hashlib.sha256()
+    with open(data, 'rb') as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tile_key(source_hash: str, scale: int, name: str, params: tuple = (),
+             background_hash: str = None) -> str:
+    '''
+    Cache key of one transform of one source
+    '''
+    text = json.dumps([source_hash, scale, name, list(params), background_hash])
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class TransformCache:
+    '''
+    Tile key -> rendered SimpleImage
+    '''
+    def __init__(self, directory: str = None, max_items: int = 256,
+                 max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._tiles = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, key: str) -> str:
+        '''
+        File holding the raw tile with this key
+        '''
+        return os.path.join(self.directory, key + '.raw')
+
+    def get(self, key: str) -> SimpleImage:
+        '''
+        The tile stored under key, or None
+        '''
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return self._tiles[key]
+        image = self._read(key) if self.directory is not None else None
+        with self._lock:
+            if image is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, image)
+        return image
+
+    def put(self, key: str, image: SimpleImage):
+        '''
+        Stores a tile under key
+        '''
+        with self._lock:
+            self._remember(key, image)
+        if self.directory is not None and not os.path.exists(self.path_for(key)):
+            size = self._write(key, image)
+            with self._lock:
+                if self._disk_bytes is None:
+                    self._disk_bytes = self.total_bytes()
+                else:
+                    self._disk_bytes += size
+                full = self._disk_bytes > self.max_bytes
+            if full:
+                self.evict(self.max_bytes * (1 - SWEEP_FREES))
+
+    def _remember(self, key: str, image: SimpleImage):
+        self._tiles[key] = image
+        self._tiles.move_to_end(key)
+        while len(self._tiles) > self.max_items:
+            self._tiles.popitem(last=False)
+
+    def _read(self, key: str) -> SimpleImage:
+        try:
+            with open(self.path_for(key), 'rb') as file:
+                magic, width, height = HEADER.unpack(file.read(HEADER.size))
+                data = file.read()
+        except (OSError, struct.error):
+            return None
+        if magic != MAGIC or len(data) != width * height * 3:
+            return None
+        try:
+            os.utime(self.path_for(key))
+        except OSError:
+            pass
+        return SimpleImage.from_pil(Image.frombytes('RGB', (width, height), data))
+
+    def _write(self, key: str, image: SimpleImage) -> int:
+        pil_image = image.pil_image
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(HEADER.pack(MAGIC, pil_image.width, pil_image.height))
+                file.write(pil_image.tobytes())
+            os.replace(tmp, self.path_for(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return HEADER.size + pil_image.width * pil_image.height * 3
+
+    def _files(self) -> list:
+        '''
+        (last used, size, path) of each raw file, least recently used first
+        '''
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.raw'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return sorted(files)
+
+    def total_bytes(self) -> int:
+        '''
+        Size of all raw files
+        '''
+        return sum(size for _, size, _ in self._files())
+
+    def evict(self, limit: float = None):
+        '''
+        Removes least recently used raw files until under limit bytes,
+        max_bytes by default
+        '''
+        if limit is None:
+            limit = self.max_bytes
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        # the most recently used file always stays
+        for _, size, path in files[:-1]:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+    def stats(self) -> dict:
+        '''
+        Tiles held in memory and hit counts
+        '''
+        with self._lock:
+            return {'size': len(self._tiles), 'hits': self.hits,
+                    'disk_hits': self.disk_hits, 'misses': self.misses}